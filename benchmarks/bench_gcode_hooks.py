@@ -0,0 +1,77 @@
+# coding=utf-8
+# Per-line overhead of the G-code hooks on a typical print, against the original implementation: python benchmarks/bench_gcode_hooks.py
+
+import re
+
+from harness import per_call_seconds
+from octoprint.util.comm import gcode_command_for_cmd
+from octoprint_obico.gcode_hooks import GCodeHooks
+from octoprint_obico.pause_resume_sequence import PauseResumeGCodeSequence
+
+
+class Plugin:
+    def __init__(self, pause_resume_sequence):
+        self.pause_resume_sequence = pause_resume_sequence
+        self.remote_status = {'viewing': False}
+
+    def send_ws_msg_to_server(self, data, as_binary=False, **kwargs):
+        return True
+
+
+class PrintJobTracker:
+    def increment_layer_height(self, layer_num):
+        pass
+
+
+class LegacyPauseResumeGCodeSequence(PauseResumeGCodeSequence):
+    def track_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
+        with self.mutex:
+            if re.match('G9[01]', cmd, flags=re.IGNORECASE):
+                self.last_g9x = cmd
+            if re.match('M8[23]', cmd, flags=re.IGNORECASE):
+                self.last_m8x = cmd
+
+
+class LegacyGCodeHooks(GCodeHooks):
+    def queuing_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
+        self.plugin.pause_resume_sequence.track_gcode(comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs)
+        if gcode and gcode in ('M600', 'M701' or 'M702'):
+            pass
+        if gcode and 'M117 OBICO_LAYER_INDICATOR' in cmd:
+            return []
+
+    def received_gcode(self, comm, line, *args, **kwargs):
+        lineLower = line.lower()
+        if "m600" in lineLower or ("fsensor_update" in lineLower and "m600" in lineLower) \
+            or "paused for user" in lineLower or "// action:paused" in lineLower:
+            pass
+        if line and lineLower not in ['wait']:
+            self.passthru_terminal_feed(line)
+        return line
+
+
+# Mostly moves and arcs, with the odd mode switch and fan command, as sliced with arc fitting
+SENT = ['G1 X%.3f Y%.3f E%.5f' % (100 + i * 0.01, 100 - i * 0.01, i * 0.0001) for i in range(800)]
+SENT += ['G2 X%.3f Y%.3f I1.5 J0.2 E%.5f' % (100 + i * 0.01, 100 - i * 0.01, i * 0.0001) for i in range(150)]
+SENT += ['G0 X120 Y120 F9000'] * 30 + ['M83', 'G91', 'G90', 'M82', 'M106 S255', 'M204 S1000'] * 3 + ['G92 E0']
+RECEIVED = ['ok'] * 900 + ['ok T:210.0 /210.0 B:60.0 /60.0 @:64 B@:0'] * 80 + ['busy: processing'] * 20
+
+
+if __name__ == "__main__":
+    sent = [(cmd, gcode_command_for_cmd(cmd)) for cmd in SENT]
+
+    for (label, hooks) in (
+            ('legacy', LegacyGCodeHooks(Plugin(LegacyPauseResumeGCodeSequence()), PrintJobTracker())),
+            ('current', GCodeHooks(Plugin(PauseResumeGCodeSequence()), PrintJobTracker()))):
+
+        def queue_all():
+            for (cmd, gcode) in sent:
+                hooks.queuing_gcode(None, 'queuing', cmd, None, gcode)
+
+        def receive_all():
+            for line in RECEIVED:
+                hooks.received_gcode(None, line)
+
+        queuing = per_call_seconds(queue_all, 100) / len(sent)
+        receiving = per_call_seconds(receive_all, 100) / len(RECEIVED)
+        print('{:<8} queuing_gcode: {:.2f}us/line  received_gcode: {:.2f}us/line'.format(label, queuing * 1e6, receiving * 1e6))
@@ -0,0 +1,45 @@
+# coding=utf-8
+# Layer indicator matching on a synthetic G-code file, against the original regex list: python benchmarks/bench_gcode_layers.py [size in MB, default 500]
+
+import os
+import re
+import tempfile
+import time
+
+from harness import size_arg, write_synthetic_gcode
+from octoprint_obico.lib.gcode_layers import lstrip_line, is_layer_indicator
+
+LEGACY_PATTERNS = [
+    r'^;LAYER:([0-9]+)',
+    r'^; layer ([0-9]+)',
+    r'^;BEFORE_LAYER_CHANGE',
+    r"^;(( BEGIN_|BEFORE_)+LAYER_(CHANGE|OBJECT)|LAYER:[0-9]+| [<]{0,1}layer [0-9]+[>,]{0,1}).*$",
+]
+
+
+def legacy_is_layer_indicator(line):
+    line = line.decode('utf-8').lstrip()
+    return any(re.match(pattern, line) for pattern in LEGACY_PATTERNS)
+
+
+def is_layer_indicator_line(line):
+    return is_layer_indicator(lstrip_line(line))
+
+
+if __name__ == "__main__":
+    size = size_arg(500)
+    path = os.path.join(tempfile.mkdtemp(), 'synthetic.gcode')
+    layers = write_synthetic_gcode(path, size)
+    print('{}MB, {} layers'.format(size // 1024 // 1024, layers))
+
+    for (label, matcher) in (('legacy', legacy_is_layer_indicator), ('bytes', is_layer_indicator_line)):
+        found = 0
+        start = time.time()
+        with open(path, 'rb') as f:
+            for line in f:
+                if matcher(line):
+                    found += 1
+        elapsed = time.time() - start
+        print('{:<7} layers found: {} time: {:.1f}s throughput: {:.1f}MB/s'.format(label, found, elapsed, size / 1024 / 1024 / elapsed))
+
+    os.remove(path)
@@ -0,0 +1,60 @@
+# coding=utf-8
+# G-code preprocessing in blocks, against processing line by line: python benchmarks/bench_preprocessor.py [size in MB, default 500]
+
+import os
+import shutil
+import tempfile
+import time
+
+from harness import size_arg, write_synthetic_gcode
+import octoprint.filemanager.util
+from octoprint_obico.gcode_preprocessor import GcodePreProcessor
+
+
+class FileManager:
+    def __init__(self, folder):
+        self.folder = folder
+
+    def set_additional_metadata(self, *args, **kwargs):
+        pass
+
+    def path_on_disk(self, origin, path):
+        return os.path.join(self.folder, 'index.gcode')
+
+
+class Plugin:
+    def __init__(self, folder):
+        self._file_manager = FileManager(folder)
+
+
+class LineByLinePreProcessor(octoprint.filemanager.util.LineProcessorStream):
+    def __init__(self, input_stream, plugin):
+        super(LineByLinePreProcessor, self).__init__(input_stream)
+        self.processor = GcodePreProcessor(None, plugin, None)
+
+    def process_line(self, line):
+        return self.processor.process_line(line)
+
+
+if __name__ == "__main__":
+    size = size_arg(500)
+    tmp_dir = tempfile.mkdtemp()
+    plugin = Plugin(tmp_dir)
+    src_path = os.path.join(tmp_dir, 'synthetic.gcode')
+    write_synthetic_gcode(src_path, size)
+
+    outputs = []
+    for (label, make_stream) in (
+            ('per-line', lambda f: LineByLinePreProcessor(f, plugin)),
+            ('block', lambda f: GcodePreProcessor(f, plugin, None))):
+        dest_path = os.path.join(tmp_dir, label + '.gcode')
+        start = time.time()
+        with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+            shutil.copyfileobj(make_stream(src), dest)
+        elapsed = time.time() - start
+        print('{:<9} {:.1f}s {:.1f}MB/s'.format(label, elapsed, size / 1024 / 1024 / elapsed))
+        outputs.append(dest_path)
+
+    with open(outputs[0], 'rb') as a, open(outputs[1], 'rb') as b:
+        print('identical output: {}'.format(a.read() == b.read()))
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,49 @@
+# coding=utf-8
+# Sending terminal-feed-sized messages one frame per message vs. in batches: python benchmarks/bench_server_msg_queue.py
+# The fake client does what WebSocketClient.send does per frame: take the mutex and build a masked websocket frame.
+
+import threading
+import time
+
+import websocket
+
+import harness  # noqa: F401  Puts this checkout on sys.path
+from octoprint_obico.server_msg_queue import ServerMessageQueue, serialize_server_msgs, MAX_DEPTHS, BULK
+
+
+class FakeClient:
+    def __init__(self):
+        self._mutex = threading.RLock()
+        self.frames = 0
+
+    def send(self, raw, as_binary=False):
+        with self._mutex:
+            opcode = websocket.ABNF.OPCODE_BINARY if as_binary else websocket.ABNF.OPCODE_TEXT
+            websocket.ABNF.create_frame(raw, opcode).format()
+            self.frames += 1
+
+
+def bench(batching, rounds=50):
+    q = ServerMessageQueue(bulk_rate=10**9, bulk_burst=10**9)
+    client = FakeClient()
+    n = 0
+    start_wall = time.time()
+    start_cpu = time.process_time()
+    for _ in range(rounds):
+        for i in range(MAX_DEPTHS[BULK]):
+            q.put({'passthru': {'terminal_feed': {'msg': 'Recv: ok T:210.0 /210.0 B:60.0 /60.0 @:64 B@:0 N{}'.format(i), '_ts': time.time()}}})
+
+        while q.qsize() > 0:
+            msgs = q.get_batch(window=0) if batching else [q.get()]
+            (raw, as_binary) = serialize_server_msgs(msgs)
+            client.send(raw, as_binary=as_binary)
+            n += len(msgs)
+    wall = time.time() - start_wall
+    cpu = time.process_time() - start_cpu
+    print('{:<10} msgs: {} frames: {} frames/s: {:.0f} msgs/s: {:.0f} CPU/msg: {:.1f}us'.format(
+        'batched' if batching else 'unbatched', n, client.frames, client.frames / wall, n / wall, cpu / n * 1e6))
+
+
+if __name__ == "__main__":
+    bench(False)
+    bench(True)
@@ -0,0 +1,81 @@
+# coding=utf-8
+# Cost of building status for multi-tool printers, in both modes: python benchmarks/bench_status.py
+
+import copy
+import re
+
+from harness import per_call_seconds
+from octoprint_obico.print_job_tracker import PrintJobTracker
+
+CURRENT_DATA = {
+    'state': {'text': 'Printing', 'flags': {'operational': True, 'printing': True, 'paused': False, 'ready': False, 'error': False}, 'error': ''},
+    'job': {'file': {'name': 'benchy.gcode', 'path': 'benchy.gcode', 'origin': 'local', 'size': 5123456, 'date': 1700000000},
+            'estimatedPrintTime': 5400.0, 'lastPrintTime': None, 'filament': {'tool0': {'length': 5000.0, 'volume': 12.0}}, 'user': '_api'},
+    'progress': {'completion': 42.0, 'filepos': 2151851, 'printTime': 2268, 'printTimeLeft': 3132, 'printTimeLeftOrigin': 'estimate'},
+    'currentZ': 12.4, 'offsets': {}, 'resends': {'count': 0, 'transmitted': 123456, 'ratio': 0},
+}
+
+
+def temperatures(tools, extra_keys=()):
+    temps = {'tool%d' % i: {'actual': 210.1, 'target': 210.0, 'offset': 0} for i in range(tools)}
+    temps['bed'] = {'actual': 60.2, 'target': 60.0, 'offset': 0}
+    temps['chamber'] = {'actual': 35.0, 'target': None, 'offset': 0}
+    for k in extra_keys:
+        temps[k] = {'actual': 0.0, 'target': None, 'offset': 0}
+    return temps
+
+
+def legacy_filter_temperatures(temps):
+    temperatures = {}
+    for (k, v) in temps.items():
+        if re.search(r'^(tool\d+|bed|chamber)$', k):
+            temperatures[k] = v
+    return temperatures
+
+
+class Printer:
+    def __init__(self, temps):
+        self.temps = temps
+
+    def get_current_data(self):
+        return copy.deepcopy(CURRENT_DATA)   # As OctoPrint does
+
+    def get_current_temperatures(self):
+        return {k: dict(v) for (k, v) in self.temps.items()}
+
+
+class StorageManager:
+    def get_metadata(self, path):
+        return {'analysis': {'printingArea': {'maxX': 200.0, 'minX': 10.0}, 'filament': {'tool0': {'length': 5000.0}}}, 'hash': 'abc'}
+
+
+class FileManager:
+    _storage_managers = {'local': StorageManager()}
+
+    def path_on_disk(self, origin, path):
+        return path
+
+
+class SettingsUpdater:
+    def as_dict(self):
+        return {'webcam': {'flipV': False}}
+
+
+class Plugin:
+    def __init__(self, temps):
+        self._printer = Printer(temps)
+        self._file_manager = FileManager()
+        self.octoprint_settings_updater = SettingsUpdater()
+
+
+if __name__ == "__main__":
+    for (label, temps) in (('1 tool', temperatures(1)), ('5 tools', temperatures(5)), ('5 tools + junk', temperatures(5, ('P', 'A', 'W', 'B1')))):
+        tracker = PrintJobTracker()
+        plugin = Plugin(temps)
+        number = 20000
+        for status_only in (True, False):
+            t = per_call_seconds(lambda: tracker.status(plugin, status_only=status_only), number)
+            print('{:<15} status(status_only={}): {:.1f}us'.format(label, status_only, t * 1e6))
+        legacy = per_call_seconds(lambda: legacy_filter_temperatures(plugin._printer.get_current_temperatures()), number)
+        current = per_call_seconds(lambda: tracker.filter_temperatures(plugin._printer.get_current_temperatures()), number)
+        print('{:<15} temperature filter: legacy {:.2f}us current {:.2f}us'.format(label, legacy * 1e6, current * 1e6))
@@ -0,0 +1,67 @@
+# coding=utf-8
+# Latency of tunnel v2 requests to a local HTTP/1.1 server with the pooled session vs. a new connection per request: python benchmarks/bench_tunnel.py
+
+import tempfile
+import threading
+import time
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+import harness  # noqa: F401  Puts this checkout on sys.path
+from octoprint_obico.tunnel import LocalTunnel
+
+BODY = b'{"state": {"text": "Operational"}}'
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True    # Headers and body are written separately. Delayed ACKs would add 40ms to every keep-alive request
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def bench(tunnel, label, n=500):
+    latencies = []
+    for _ in range(n):
+        start = time.time()
+        tunnel.send_http_to_local_v2(ref='bench', method='get', path='/api/printer', headers={'Cookie': 'session=abc'})
+        latencies.append(time.time() - start)
+    latencies.sort()
+    print('{:<10} avg: {:.2f}ms p50: {:.2f}ms p99: {:.2f}ms'.format(
+        label, sum(latencies) / n * 1000, latencies[n // 2] * 1000, latencies[int(n * 0.99)] * 1000))
+
+
+if __name__ == "__main__":
+    server = Server(('127.0.0.1', 0), Handler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    tunnel = LocalTunnel(
+        base_url='http://127.0.0.1:{}'.format(server.server_address[1]),
+        on_http_response=lambda msg, as_binary=False, **kwargs: None,
+        on_ws_message=None,
+        data_dir=tempfile.mkdtemp(),
+        sentry=None,
+        cache_bytes=0)
+
+    pooled_session = tunnel.v2_session
+    tunnel.v2_session = requests   # What v2 did before: module-level requests.get, i.e. a new connection every time
+    bench(tunnel, 'unpooled')
+    tunnel.v2_session = pooled_session
+    bench(tunnel, 'pooled')
+    print('cookies kept by the pooled session: {}'.format(len(tunnel.v2_session.cookies)))
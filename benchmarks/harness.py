@@ -0,0 +1,33 @@
+# coding=utf-8
+
+### Shared by the benchmark scripts in this folder. Not part of the plugin, nor installed with it.
+#   Run the scripts from anywhere, e.g. python benchmarks/bench_gcode_layers.py. They import the plugin from this checkout.
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def per_call_seconds(fn, number, repeat=5):
+    # Best of `repeat` runs, per call
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def size_arg(default_mb):
+    # Return: the size in bytes given as the first argument in MB, or the default
+    return (int(sys.argv[1]) if len(sys.argv) > 1 else default_mb) * 1024 * 1024
+
+
+def write_synthetic_gcode(path, size):
+    # Layers of 2000 extrusion moves, the bulk of any real file. Return: the number of layers
+    layer = 0
+    with open(path, 'wb') as f:
+        while f.tell() < size:
+            layer += 1
+            lines = [b';LAYER:%d\n' % layer, b'G1 Z%.2f F7800\n' % (layer * 0.2), b';TYPE:WALL-OUTER\n']
+            lines += [b'G1 X%.3f Y%.3f E%.5f\n' % (100 + i * 0.01, 100 - i * 0.01, layer + i * 0.0001) for i in range(2000)]
+            lines.append(b'  M106 S255 ; fan\n\n')
+            f.write(b''.join(lines))
+    return layer
@@ -14,22 +14,18 @@ import backoff
 from collections import deque
 
 from octoprint_obico.nozzlecam import NozzleCam
-try:
-    import queue
-except ImportError:
-    import Queue as queue
 
-from .ws import WebSocketClient, WebSocketConnectionException
+from .ws import create_ws_client, use_asyncio_transport, WebSocketConnectionException
 from .pause_resume_sequence import PauseResumeGCodeSequence
 from .utils import (
     ExpoBackoff, SentryWrapper, pi_version,
     OctoPrintSettingsUpdater, run_in_thread,
-    server_request, migrate_tsd_settings,)
+    server_request, server_session, migrate_tsd_settings,)
 from .lib.error_stats import error_stats
 from .lib import alert_queue
 from .print_job_tracker import PrintJobTracker
 from .remote_status import RemoteStatus
-from .webcam_capture import JpegPoster, capture_jpeg
+from .webcam_capture import JpegPoster, capture_jpeg, jpeg_frame_cache
 from .file_downloader import FileDownloader
 from .tunnel import LocalTunnel
 from . import plugin_apis
@@ -37,8 +33,15 @@ from .client_conn import ClientConn
 import zlib
 from .printer_discovery import PrinterDiscovery
 from .gcode_hooks import GCodeHooks
-from .gcode_preprocessor import GcodePreProcessorWrapper
+from .gcode_preprocessor import GcodePreProcessorWrapper, preprocessing_pool
+from .lib.layer_index import remove_sidecar, move_sidecar
+from .lib.preprocess_cache import preprocess_cache
+from .lib.file_metadata_cache import file_metadata_cache, FileMetadataElider, FILE_METADATA_EVENTS
 from .file_operations import FileOperations
+from .server_msg_queue import ServerMessageQueue, serialize_server_msgs
+from .status_delta import StatusDeltaEncoder
+from .status_push import StatusPushCallback, StatusChangeFilter
+from .lib.debouncer import Debouncer
 from .webcam_stream import WebcamStreamer, get_webcam_configs
 
 import octoprint.plugin
@@ -48,6 +51,11 @@ __python_version__ = 3 if sys.version_info >= (3, 0) else 2
 _logger = logging.getLogger('octoprint.plugins.obico')
 
 POST_STATUS_INTERVAL_SECONDS = 50.0
+CLIENT_STATUS_HEARTBEAT_SECONDS = 20.0   # Status is pushed to the client as it changes. This is only for when it doesn't
+STATUS_BOOST_SECONDS = 15.0     # Heartbeat to the server is more frequent for a while after an event
+STATUS_PUSH_MIN_LATENCY_SECONDS = 0.1
+STATUS_PUSH_MAX_LATENCY_SECONDS = 0.5
+CLIENT_STATUS_KEYFRAME_INTERVAL = 10  # Data channel is lossy. Recover from lost deltas sooner.
 
 DEFAULT_LINKED_PRINTER = {'is_pro': False}
 
@@ -71,9 +79,20 @@ class ObicoPlugin(
         self.shutting_down = False
         self.ss = None
         self.status_posted_to_server_ts = 0
-        self.message_queue_to_server = queue.Queue(maxsize=1000)
-        self.status_update_booster = 0    # update status at higher frequency when self.status_update_booster > 0
-        self.status_update_lock = threading.RLock()
+        self.message_queue_to_server = ServerMessageQueue()
+        self.status_delta_encoding = False
+        self.server_status_encoder = StatusDeltaEncoder()
+        self.file_metadata_versioning = False
+        self.server_file_metadata_elider = FileMetadataElider()
+        self.client_status_encoder = StatusDeltaEncoder(keyframe_interval=CLIENT_STATUS_KEYFRAME_INTERVAL)
+        self.status_boosted_until = 0
+        self.client_status_filter = StatusChangeFilter(CLIENT_STATUS_HEARTBEAT_SECONDS)
+        self.client_status_debouncer = Debouncer(
+            self.post_printer_status_to_client, STATUS_PUSH_MIN_LATENCY_SECONDS, STATUS_PUSH_MAX_LATENCY_SECONDS,
+            heartbeat=CLIENT_STATUS_HEARTBEAT_SECONDS)
+        self.server_status_debouncer = Debouncer(
+            self.post_update_to_server, STATUS_PUSH_MIN_LATENCY_SECONDS, STATUS_PUSH_MAX_LATENCY_SECONDS,
+            heartbeat=self.server_status_heartbeat, on_error=lambda: self.sentry.captureException())
         self.remote_status = RemoteStatus()
         self.pause_resume_sequence = PauseResumeGCodeSequence()
         self.gcode_hooks = GCodeHooks(self, _print_job_tracker)
@@ -108,6 +127,28 @@ class ObicoPlugin(
             sentry_opt='out',
             webcams=[],
             nozzle_camera='',
+            batch_server_msgs=False,
+            status_delta_encoding=False,
+            jpeg_cache_max_age=1.0,
+            asyncio_ws_transport=False,
+            server_http_pool_size=4,
+            tunnel_workers=4,
+            tunnel_backlog=64,
+            tunnel_streaming=False,
+            tunnel_compression_codec='zlib',
+            tunnel_compression_level=None,
+            tunnel_cache_mb=16,
+            tunnel_ws_credit_window=32,
+            parallel_preprocessing=False,
+            preprocessing_workers=0,
+            preprocessing_cache_mb=0,
+            terminal_feed_batching=False,
+            terminal_feed_flush_ms=100,
+            terminal_feed_max_lines=50,
+            terminal_feed_max_rate=100,
+            status_push_min_latency_ms=100,
+            status_push_max_latency_ms=500,
+            file_metadata_versioning=False,
         )
 
     def on_settings_save(self, data):
@@ -170,6 +211,11 @@ class ObicoPlugin(
         self.boost_status_update()
 
         try:
+            if event in FILE_METADATA_EVENTS:
+                file_metadata_cache.invalidate(payload.get('storage') or payload.get('origin'), payload.get('path'))
+            if event in ('Connected', 'Disconnected'):
+                _print_job_tracker.reset_temperature_keys()
+
             if event == 'FirmwareData':
                 self.octoprint_settings_updater.update_firmware(payload)
                 self.post_update_to_server()
@@ -188,12 +234,20 @@ class ObicoPlugin(
                     self.post_update_to_server(data=event_payload)
             elif event == 'FilamentChange':
                 run_in_thread(self.post_filament_change_event)
+            elif event == 'FileRemoved' and payload.get('storage') == 'local':
+                remove_sidecar(self._file_manager.path_on_disk('local', payload['path']))
+            elif event == 'FileMoved' and payload.get('source_storage') == 'local' and payload.get('destination_storage') == 'local':
+                move_sidecar(
+                    self._file_manager.path_on_disk('local', payload['source_path']),
+                    self._file_manager.path_on_disk('local', payload['destination_path']))
         except Exception as e:
             self.sentry.captureException()
     # ~~Shutdown Plugin
 
     def on_shutdown(self):
         self.shutting_down = True
+        self.client_status_debouncer.stop()
+        self.server_status_debouncer.stop()
         if self.ss is not None:
             self.ss.close()
         if self.webcam_streamer:
@@ -225,6 +279,13 @@ class ObicoPlugin(
         if self.bailed_because_tsd_plugin_running:
             return
 
+        preprocessing_pool.configure(
+            self._settings.get_boolean(["parallel_preprocessing"]),
+            workers=self._settings.get_int(["preprocessing_workers"]))
+        preprocess_cache.configure(
+            os.path.join(self.get_plugin_data_folder(), 'preprocessed_gcode'),
+            (self._settings.get_int(["preprocessing_cache_mb"]) or 0) * 1024 * 1024)
+
         main_thread = threading.Thread(target=self.main_loop)
         main_thread.daemon = True
         main_thread.start()
@@ -244,6 +305,16 @@ class ObicoPlugin(
             self.discovery = None
 
         self.linked_printer = self.wait_for_auth_token().get('printer', DEFAULT_LINKED_PRINTER)
+        self.status_delta_encoding = self._settings.get_boolean(["status_delta_encoding"])
+        self.file_metadata_versioning = self._settings.get_boolean(["file_metadata_versioning"])
+        jpeg_frame_cache.max_age = self._settings.get_float(["jpeg_cache_max_age"])
+        use_asyncio_transport(self._settings.get_boolean(["asyncio_ws_transport"]))
+        server_session.configure(self._settings.get_int(["server_http_pool_size"]))
+        self.gcode_hooks.terminal_feed.configure(
+            batched=self._settings.get_boolean(["terminal_feed_batching"]),
+            flush_interval=self._settings.get_int(["terminal_feed_flush_ms"]) / 1000.0,
+            max_lines=self._settings.get_int(["terminal_feed_max_lines"]),
+            max_rate=self._settings.get_int(["terminal_feed_max_rate"]))
 
         self.sentry.init_context()
         _logger.info('Linked printer: {}'.format(self.linked_printer))
@@ -263,13 +334,25 @@ class ObicoPlugin(
             on_http_response=self.send_ws_msg_to_server,
             on_ws_message=self.send_ws_msg_to_server,
             data_dir=self.get_plugin_data_folder(),
-            sentry=self.sentry)
+            sentry=self.sentry,
+            http_workers=self._settings.get_int(["tunnel_workers"]),
+            http_backlog=self._settings.get_int(["tunnel_backlog"]),
+            stream_responses=self._settings.get_boolean(["tunnel_streaming"]),
+            compression_codec=self._settings.get(["tunnel_compression_codec"]),
+            compression_level=self._settings.get_int(["tunnel_compression_level"]),
+            cache_bytes=self._settings.get_int(["tunnel_cache_mb"]) * 1024 * 1024,
+            ws_credit_window=self._settings.get_int(["tunnel_ws_credit_window"]))
+
+        for debouncer in (self.client_status_debouncer, self.server_status_debouncer):
+            debouncer.min_latency = self._settings.get_int(["status_push_min_latency_ms"]) / 1000.0
+            debouncer.max_latency = max(debouncer.min_latency, self._settings.get_int(["status_push_max_latency_ms"]) / 1000.0)
+        self._printer.register_callback(StatusPushCallback(self.client_status_debouncer.trigger, self.server_status_debouncer.trigger))
 
         jpeg_post_thread = threading.Thread(target=self.jpeg_poster.pic_post_loop)
         jpeg_post_thread.daemon = True
         jpeg_post_thread.start()
 
-        status_update_to_client_thread = threading.Thread(target=self.status_update_to_client_loop)
+        status_update_to_client_thread = threading.Thread(target=self.client_status_debouncer.run)
         status_update_to_client_thread.daemon = True
         status_update_to_client_thread.start()
 
@@ -277,24 +360,22 @@ class ObicoPlugin(
         message_to_server_thread.daemon = True
         message_to_server_thread.start()
 
-        while True:
-            try:
-                interval_in_seconds = POST_STATUS_INTERVAL_SECONDS
-                if self.status_update_booster > 0:
-                    interval_in_seconds /= 5
-
-                if self.status_posted_to_server_ts < time.time() - interval_in_seconds:
-                    self.post_update_to_server()
+        # Posts status to the server when the printer state changes, and as a heartbeat
+        self.server_status_debouncer.trigger()
+        self.server_status_debouncer.run()
 
-            except Exception as e:
-                self.sentry.captureException()
+    def message_to_server_loop(self):
 
-            time.sleep(1)
+        # Held while self.ss is being connected, so the callbacks of a new connection can tell it's the current one
+        ss_mutex = threading.RLock()
 
-    def message_to_server_loop(self):
+        def is_current_ss(ws):
+            # ws: the client itself (asyncio transport), or its WebSocketApp (websocket-client)
+            with ss_mutex:
+                return self.ss is not None and (self.ss is ws or (self.ss.ws is not None and self.ss.ws == ws))
 
         def on_server_ws_close(ws, close_status_code):
-            if self.ss and self.ss.ws and self.ss.ws == ws:
+            if is_current_ss(ws):
                 self._plugin_manager.send_plugin_message(self._identifier, {'plugin_updated': True})
                 self.local_tunnel.close_all_octoprint_ws()
                 self.ss = None
@@ -311,14 +392,18 @@ class ObicoPlugin(
                     self.on_shutdown()
 
         def on_server_ws_open(ws):
-            if self.ss and self.ss.ws and self.ss.ws == ws:
+            if is_current_ss(ws):
                 self._plugin_manager.send_plugin_message(self._identifier, {'plugin_updated': True})
                 self.post_update_to_server() # Make sure an update is sent asap so that the server can rely on the availability of essential info such as agent.version
 
         server_ws_backoff = ExpoBackoff(300)
+        batch_server_msgs = self._settings.get_boolean(["batch_server_msgs"])
         while self.shutting_down is False:
             try:
-                (data, as_binary) = self.message_queue_to_server.get()
+                if batch_server_msgs:
+                    msgs = self.message_queue_to_server.get_batch()
+                else:
+                    msgs = [self.message_queue_to_server.get()]
 
                 if not self.is_configured():
                     _logger.warning("Plugin not configured. Not sending message to server...")
@@ -331,28 +416,33 @@ class ObicoPlugin(
                 error_stats.attempt('server')
 
                 if not self.ss or not self.ss.connected():
-                    self.ss = WebSocketClient(self.canonical_ws_prefix() + "/ws/dev/", token=self.auth_token(), on_ws_msg=self.process_server_msg, on_ws_close=on_server_ws_close, on_ws_open=on_server_ws_open)
-
-                if as_binary:
-                    raw = bson.dumps(data)
-                    _logger.debug("Sending binary ({} bytes) to server".format(len(raw)))
-                else:
-                    _logger.debug("Sending to server: \n{}".format(data))
-                    if __python_version__ == 3:
-                        raw = json.dumps(data, default=str)
-                    else:
-                        raw = json.dumps(data, encoding='iso-8859-1', default=str)
+                    self.server_status_encoder.reset()
+                    self.server_file_metadata_elider.reset()
+                    with ss_mutex:
+                        self.ss = create_ws_client(self.canonical_ws_prefix() + "/ws/dev/", token=self.auth_token(), on_ws_msg=self.process_server_msg, on_ws_close=on_server_ws_close, on_ws_open=on_server_ws_open)
+
+                # Deltas already leave out file_metadata while it's unchanged. Eliding it too would make it look removed
+                if self.file_metadata_versioning and not self.status_delta_encoding:
+                    msgs = [(self.server_file_metadata_elider.elide(data), as_binary) for (data, as_binary) in msgs]
+                if self.status_delta_encoding:
+                    msgs = [(self.delta_encode_status_for_server(data), as_binary) for (data, as_binary) in msgs]
+
+                (raw, as_binary) = serialize_server_msgs(msgs)
                 self.ss.send(raw, as_binary=as_binary)
                 server_ws_backoff.reset()
             except WebSocketConnectionException as e:
                 _logger.warning(e)
                 error_stats.add_connection_error('server', self)
+                self.server_status_encoder.reset()
+                self.server_file_metadata_elider.reset()
                 if self.ss:
                     self.ss.close()
                 server_ws_backoff.more(e)
             except Exception as e:
                 self.sentry.captureException()
                 error_stats.add_connection_error('server', self)
+                self.server_status_encoder.reset()
+                self.server_file_metadata_elider.reset()
                 if self.ss:
                     self.ss.close()
                 server_ws_backoff.more(e)
@@ -362,12 +452,23 @@ class ObicoPlugin(
             data = _print_job_tracker.status(self)
         self.send_ws_msg_to_server(data)
         self.status_posted_to_server_ts = time.time()
+        self.server_status_debouncer.called_elsewhere()
 
-    def send_ws_msg_to_server(self, data, as_binary=False):
-        try:
-            self.message_queue_to_server.put_nowait((data, as_binary))
-        except queue.Full:
+    def delta_encode_status_for_server(self, data):
+        if 'status' not in data:
+            return data
+
+        # Has to happen right before sending so that deltas are always relative to what the server actually received last
+        encoded = {k: v for (k, v) in data.items() if k != 'status'}
+        encoded.update(self.server_status_encoder.encode(data['status'], force_keyframe='event' in data))
+        return encoded
+
+    def send_ws_msg_to_server(self, data, as_binary=False, **kwargs):
+        # kwargs: see ServerMessageQueue.put
+        if not self.message_queue_to_server.put(data, as_binary=as_binary, **kwargs):
             _logger.warning("Server message queue is full, msg dropped")
+            return False
+        return True
 
     def process_server_msg(self, ws, raw_data):
         global _print_job_tracker
@@ -415,22 +516,13 @@ class ObicoPlugin(
                 need_status_boost = True
                 if self.remote_status['viewing']:
                     self.jpeg_poster.need_viewing_boost.set()
+                    self.client_status_encoder.reset()  # A viewer may have just joined. Give them a keyframe
 
             if msg.get('http.tunnel') and self.local_tunnel:
-                kwargs = msg.get('http.tunnel')
-                tunnel_thread = threading.Thread(
-                    target=self.local_tunnel.send_http_to_local,
-                    kwargs=kwargs)
-                tunnel_thread.is_daemon = True
-                tunnel_thread.start()
+                self.local_tunnel.submit_http_to_local(msg.get('http.tunnel'))
 
             if msg.get('http.tunnelv2') and self.local_tunnel:
-                kwargs = msg.get('http.tunnelv2')
-                tunnel_thread = threading.Thread(
-                    target=self.local_tunnel.send_http_to_local_v2,
-                    kwargs=kwargs)
-                tunnel_thread.is_daemon = True
-                tunnel_thread.start()
+                self.local_tunnel.submit_http_to_local_v2(msg.get('http.tunnelv2'))
 
             if msg.get('ws.tunnel') and self.local_tunnel:
                 kwargs = msg.get('ws.tunnel')
@@ -442,22 +534,25 @@ class ObicoPlugin(
         except:
             self.sentry.captureException()
 
-    def status_update_to_client_loop(self):
-        while self.shutting_down is False:
-            interval = 0.75 if self.status_update_booster > 0 else 2
-            time.sleep(interval)
-            self.post_printer_status_to_client()
-            with self.status_update_lock:
-                self.status_update_booster -= 1
-
     def post_printer_status_to_client(self):
-        status = _print_job_tracker.status(self, status_only=True)
-        self.client_conn.send_msg_to_client({'status': status.get('status', {})})
+        status = _print_job_tracker.status(self, status_only=True).get('status', {})
+        if not self.client_status_filter.should_send(status):
+            return
+        if self.status_delta_encoding:
+            self.client_conn.send_msg_to_client(self.client_status_encoder.encode(status))
+        else:
+            self.client_conn.send_msg_to_client({'status': status})
 
     def boost_status_update(self):
-        self.post_printer_status_to_client()
-        with self.status_update_lock:
-            self.status_update_booster = 20
+        self.client_status_filter.force()
+        self.client_status_debouncer.trigger()
+        self.status_boosted_until = time.time() + STATUS_BOOST_SECONDS
+        self.server_status_debouncer.wake()
+
+    def server_status_heartbeat(self):
+        if time.time() < self.status_boosted_until:
+            return POST_STATUS_INTERVAL_SECONDS / 5
+        return POST_STATUS_INTERVAL_SECONDS
 
     def post_printer_event_to_server(self, event_data, attach_snapshot=False, spam_tolerance_seconds=60*60*24*1000):
         event_title = event_data['event_title']
@@ -475,7 +570,7 @@ class ObicoPlugin(
             except Exception as e:
                 _logger.warning('Failed to capture jpeg - ' + str(e))
                 pass
-        resp = server_request('POST', '/api/v1/octo/printer_events/', self, timeout=60, files=files, data=event_data, headers=self.auth_headers())
+        resp = server_request('POST', '/api/v1/octo/printer_events/', self, files=files, data=event_data, headers=self.auth_headers())
 
     def post_filament_change_event(self):
         event_text = '<div><i>Printer:</i> {}</div><div><i>G-Code:</i> {}</div>'.format(
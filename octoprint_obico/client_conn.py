@@ -24,6 +24,9 @@ class ClientConn:
 
     def open_data_channel(self, port):
         self.printer_data_channel_conn = DataChannelConn('127.0.0.1', port)
+        self.plugin.client_status_encoder.reset()   # The first status on the new data channel is a keyframe
+        self.plugin.client_status_filter.force()
+        self.plugin.client_status_debouncer.trigger()
 
     def on_message_to_plugin(self, msg):
         target = getattr(self.plugin, msg.get('target'))
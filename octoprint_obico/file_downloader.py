@@ -8,6 +8,7 @@ from octoprint.filemanager.util import AbstractFileWrapper
 import io
 
 from .utils import server_request, get_file_metadata
+from .lib.preprocess_cache import bytes_hash
 
 _logger = logging.getLogger('octoprint.plugins.obico')
 UPLOAD_FOLDER = 'ObicoUpload'
@@ -29,6 +30,10 @@ class RequestFileWrapper(AbstractFileWrapper):
     def stream(self):
         return io.BytesIO(self.req.content)
 
+    def content_hash(self):
+        # For the preprocess cache
+        return bytes_hash(self.req.content)
+
 
 class FileDownloader:
 
@@ -74,7 +79,7 @@ class FileDownloader:
 
             if md5_hash:
                 g_code_data = dict(agent_signature='md5:{}'.format(md5_hash), safe_filename=os.path.basename(target_path))
-                resp = server_request('PATCH', '/api/v1/octo/g_code_files/{}/'.format(g_code_file['id']), self.plugin, timeout=60, data=g_code_data, headers=self.plugin.auth_headers())
+                resp = server_request('PATCH', '/api/v1/octo/g_code_files/{}/'.format(g_code_file['id']), self.plugin, data=g_code_data, headers=self.plugin.auth_headers())
 
             self.plugin._printer.select_file(target_path, False, printAfterSelect=True)
 
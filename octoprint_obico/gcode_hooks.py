@@ -1,28 +1,40 @@
 import logging
-import re
-import sys
-import time
-import octoprint
 
 from .utils import run_in_thread
+from .terminal_feed import TerminalFeed
 
 _logger = logging.getLogger('octoprint.plugins.obico')
 
+# The hooks are called for every line sent to or received from the printer. Most lines need nothing done, and should cost as little as possible.
+
+# Moves are the bulk of any print, and none of the hooks care about them
+MOVE_GCODES = frozenset(('G0', 'G1', 'G2', 'G3'))
+# Commands that PauseResumeGCodeSequence needs to keep track of
+POSITIONING_MODE_GCODES = frozenset(('G90', 'G91', 'M82', 'M83'))
+FILAMENT_CHANGE_GCODES = frozenset(('M600', 'M701'))
+LAYER_INDICATOR = 'M117 OBICO_LAYER_INDICATOR'
+
+
 class GCodeHooks:
 
     def __init__(self, plugin, _print_job_tracker):
         self.plugin = plugin
         self._print_job_tracker = _print_job_tracker
         self.terminal_feed_is_on = False
+        self.terminal_feed = TerminalFeed(plugin.send_ws_msg_to_server)
 
     def queuing_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
-        self.plugin.pause_resume_sequence.track_gcode(comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs)
+        if gcode in MOVE_GCODES:
+            return
+
+        if gcode is None or gcode in POSITIONING_MODE_GCODES:  # gcode is None when OctoPrint can't parse cmd, e.g. lower case 'g91'
+            self.plugin.pause_resume_sequence.track_gcode(comm_instance, phase, cmd, cmd_type, gcode)
 
-        if gcode and gcode in ('M600', 'M701' or 'M702'):
+        if gcode in FILAMENT_CHANGE_GCODES:
             run_in_thread(self.plugin.post_filament_change_event)
 
-        if gcode and 'M117 OBICO_LAYER_INDICATOR' in cmd:
-            layer_num = int(cmd.replace("M117 OBICO_LAYER_INDICATOR ", ""))
+        if gcode == 'M117' and LAYER_INDICATOR in cmd:
+            layer_num = int(cmd.replace(LAYER_INDICATOR + " ", ""))
 
             # First layer AI-related
             if layer_num == 1:
@@ -38,12 +50,12 @@ class GCodeHooks:
     def received_gcode(self, comm, line, *args, **kwargs):
 
         # credit: https://github.com/QuinnDamerell/OctoPrint-OctoEverywhere/blob/ef37e6c9ce6798e8af54a5fd81215d430c05bfad/octoprint_octoeverywhere/__init__.py#L272
+        # Plain substring checks on the lower-cased line are faster than a single case-insensitive regex for lines this short
         lineLower = line.lower()
-        if "m600" in lineLower or ("fsensor_update" in lineLower and "m600" in lineLower) \
-            or "paused for user" in lineLower or "// action:paused" in lineLower:
+        if "m600" in lineLower or "paused for user" in lineLower or "// action:paused" in lineLower:
             run_in_thread(self.plugin.post_filament_change_event)
 
-        if line and lineLower not in ['wait']:
+        if line and lineLower != 'wait':
             self.passthru_terminal_feed(line)
 
         return line
@@ -53,13 +65,13 @@ class GCodeHooks:
             self.passthru_terminal_feed(cmd)
 
     def passthru_terminal_feed(self, msg):
-        # No need to run in thread, as send_ws_msg_to_server is non-blocking
         if self.plugin.remote_status['viewing'] and self.terminal_feed_is_on:
-            self.plugin.send_ws_msg_to_server({'passthru': {'terminal_feed': {'msg': msg,'_ts': time.time()}}})
+            self.terminal_feed.add(msg)
 
     def toggle_terminal_feed(self, msg):
         if msg == 'on':
             self.terminal_feed_is_on = True
         elif msg == 'off':
             self.terminal_feed_is_on = False
+            self.terminal_feed.clear()
         return self.terminal_feed_is_on
@@ -1,63 +1,386 @@
+import io
 import logging
-import re
+import multiprocessing
+import os
+import shutil
 import sys
+import tempfile
+import threading
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
 import octoprint
 
+from .lib.gcode_layers import lstrip_line, is_layer_indicator, LINE_TO_PROCESS_RE
+from .lib.layer_index import LayerIndexBuilder, sidecar_path, remove_sidecar, move_sidecar
+from .lib.preprocess_cache import preprocess_cache, new_hash, file_hash
+
 
 _logger = logging.getLogger('octoprint.plugins.obico')
 __python_version__ = 3 if sys.version_info >= (3, 0) else 2
 
 
+BLOCK_SIZE = 1024 * 1024
+
+# How long a worker process may take before the upload is preprocessed in-process instead. Generous: Pis are slow
+POOL_TIMEOUT_SECONDS = 60
+POOL_TIMEOUT_SECONDS_PER_MB = 2
+
+
 # Credit: Thank you j7126 for your awesome octoprint plugin: https://github.com/j7126/OctoPrint-Dashboard
-class GcodePreProcessor(octoprint.filemanager.util.LineProcessorStream):
-
-    LAYER_INDICATOR_PATTERNS = [
-            dict(slicer='CURA',
-                regx=r'^;LAYER:([0-9]+)'),
-            dict(slicer='Simplify3D',
-                regx=r'^; layer ([0-9]+)'),
-            dict(slicer='Slic3r/PrusaSlicer',
-                regx=r'^;BEFORE_LAYER_CHANGE'),
-            dict(slicer='Almost Everyone',
-                regx=r"^;(( BEGIN_|BEFORE_)+LAYER_(CHANGE|OBJECT)|LAYER:[0-9]+| [<]{0,1}layer [0-9]+[>,]{0,1}).*$")
-        ]
-
-
-    def __init__(self, file_buffered_reader, plugin, file_path):
-        super(GcodePreProcessor, self).__init__(file_buffered_reader)
+#
+# Reads the upload a block at a time rather than a line at a time (as octoprint.filemanager.util.LineProcessorStream does).
+# LINE_TO_PROCESS_RE finds the few lines in a block that need to be changed, and process_line is called only for them.
+# Everything in-between is copied through as is. The output is the same as processing every line.
+# The output also goes through a LayerIndexBuilder, which is saved as a sidecar next to the file when done.
+# With hash_input, the input is also hashed as it's read, for the preprocess cache (see CachingStreamWrapper).
+class GcodePreProcessor(io.RawIOBase):
+
+    def __init__(self, input_stream, plugin, file_path, block_size=BLOCK_SIZE, digest=None, hash_input=False):
+        # digest: the hash of the input, if already known
+        super(GcodePreProcessor, self).__init__()
+        self.input_stream = input_stream
         self.plugin = plugin
         self.file_path = file_path
+        self.block_size = block_size
         self.layer_count = 0
+        self.layer_index = LayerIndexBuilder()
+        self.partial_line = b''     # The end of the last block, up to where its last line would end
+        self.output = b''
+        self.output_pos = 0
+        self.eof = False
+        self.metadata_saved = False
+        self.digest = digest
+        self.input_hash = new_hash() if digest is None and hash_input else None
 
     def process_line(self, line):
         if not len(line):
             return None
 
-        if __python_version__ == 3:
-            line = line.decode('utf-8').lstrip()
-        else:
-            line = line.lstrip()
+        line = lstrip_line(line)
+
+        if is_layer_indicator(line):
+            self.layer_count += 1
+            self.layer_index.layer_started()
+            line = line + ("M117 OBICO_LAYER_INDICATOR " + str(self.layer_count) + "\r\n").encode('utf-8')
 
-        for layer_indicator_pattern in self.LAYER_INDICATOR_PATTERNS:
+        return line
 
-            if re.match(layer_indicator_pattern['regx'], line):
-                self.layer_count += 1
-                line = line + "M117 OBICO_LAYER_INDICATOR " + str(self.layer_count) + "\r\n"
+    def process_block(self, block):
+        # block: whole lines only. Return: list of output slices
+        out = []
+        copied_to = 0
+        for m in LINE_TO_PROCESS_RE.finditer(block):
+            start = m.start()
+            end = block.find(b'\n', start) + 1
 
-                break
+            if start > copied_to:
+                out.append(block[copied_to:start])
+                self.layer_index.feed(out[-1])
+            out.append(self.process_line(block[start:end]))
+            self.layer_index.feed(out[-1])
+            copied_to = end
 
-        line = line.encode('utf-8')
+        if copied_to < len(block):
+            out.append(block[copied_to:])
+            self.layer_index.feed(out[-1])
+        return out
 
-        return line
+    def fill_output(self):
+        while not self.eof:
+            data = self.input_stream.read(self.block_size)
+            if self.input_hash is not None:
+                self.input_hash.update(data)
+            if not data:
+                self.eof = True
+                last_line = self.process_line(self.partial_line) if self.partial_line else None
+                self.partial_line = b''
+                if last_line:
+                    self.layer_index.feed(last_line)
+                self.output = last_line or b''
+                self.output_pos = 0
+                return
+
+            last_newline = data.rfind(b'\n')
+            if last_newline < 0:
+                self.partial_line += data
+                continue
+
+            block = self.partial_line + data[:last_newline + 1] if self.partial_line else data[:last_newline + 1]
+            self.partial_line = data[last_newline + 1:]
+            output = b''.join(self.process_block(block))
+            if output:
+                self.output = output
+                self.output_pos = 0
+                return
+
+    def readinto(self, b):
+        if self.output_pos >= len(self.output):
+            self.fill_output()
+
+        n = min(len(b), len(self.output) - self.output_pos)
+        b[:n] = self.output[self.output_pos:self.output_pos + n]
+        self.output_pos += n
+        return n
+
+    def readable(self):
+        return True
 
     def close(self):
+        if self.metadata_saved:     # close() is also called when garbage-collected
+            return
+        self.metadata_saved = True
+        super(GcodePreProcessor, self).close()
+        if self.input_stream is not None:   # As LineProcessorStream does. Otherwise the upload's file handle is left open
+            self.input_stream.close()
+
         if self.layer_count == 0:
             self.layer_count = None #set None if no layers found - Klipper returns None as well so less checks needed on frontend
         else:
             self.layer_count += 1 #add last layer to count - match dashboard
 
+        if self.plugin is None:     # In a worker process. See preprocess_file
+            return
+
         self.plugin._file_manager.set_additional_metadata('local', self.file_path, 'obico', {"totalLayerCount": self.layer_count}, overwrite=True)
+        self.save_layer_index(self.plugin._file_manager.path_on_disk('local', self.file_path))
+
+    def input_digest(self):
+        # Return: the hash of the whole input, or None if it's not known
+        if not self.eof:    # The upload was cut short
+            return None
+        return self.digest or (self.input_hash.hexdigest() if self.input_hash is not None else None)
+
+    def save_layer_index(self, path_on_disk):
+        try:
+            if len(self.layer_index.index):
+                self.layer_index.index.save(sidecar_path(path_on_disk))
+            else:
+                remove_sidecar(path_on_disk)    # Don't leave the index of a file that's been overwritten
+        except Exception:
+            _logger.exception('Failed to save layer index for {}'.format(path_on_disk))
+
+
+def preprocess_file(src_path, dst_path, hash_input=False):
+    # Runs in a worker process of the preprocessing pool, so no plugin state here. Return: (totalLayerCount, bytes read, hash of the input or None)
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        preprocessor = GcodePreProcessor(src, None, None, hash_input=hash_input)
+        shutil.copyfileobj(preprocessor, dst, BLOCK_SIZE)
+        preprocessor.close()
+    preprocessor.save_layer_index(dst_path)
+    return (preprocessor.layer_count, os.path.getsize(src_path), preprocessor.input_digest())
+
+
+def hidden_tmp_path(dst_path, suffix):
+    # A new temporary file next to dst_path. Hidden, so that OctoPrint doesn't list it
+    (folder, filename) = os.path.split(dst_path)
+    (fd, tmp_path) = tempfile.mkstemp(dir=folder, prefix='.' + filename + '.', suffix=suffix)
+    os.close(fd)
+    return tmp_path
+
+
+def terminate_workers(executor):
+    # ProcessPoolExecutor can't cancel a task that's running. Its worker processes are killed instead. Other tasks they were running fail with BrokenProcessPool
+    if hasattr(executor, 'terminate_workers'):   # Python >= 3.14
+        executor.terminate_workers()
+        return
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    executor.shutdown(wait=False)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(5)
+
+
+def pool_context():
+    # Not fork: OctoPrint has many threads, and locks held by any of them at the time of the fork would never be released in the child
+    return multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+
+class PreprocessingPool:
+    # Preprocesses uploads that are already on disk in worker processes (opt-in with the `parallel_preprocessing` setting),
+    # so that concurrent uploads don't take turns holding the GIL.
+
+    def __init__(self):
+        self._mutex = threading.RLock()
+        self.executor = None
+        self.workers = 0
+        self.slots = None
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.recent = deque(maxlen=20)
+
+    def configure(self, enabled, workers=0):
+        with self._mutex:
+            if self.executor:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+            if not enabled:
+                return
+
+            self.workers = workers or os.cpu_count() or 1
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=pool_context())
+            self.slots = threading.BoundedSemaphore(self.workers * 2)    # Bounds the queue. Uploads beyond that wait their turn
+
+    def enabled(self):
+        with self._mutex:
+            return self.executor is not None
+
+    def preprocess(self, src_path, dst_path, hash_input=False):
+        # Blocks until done. Return: (totalLayerCount, hash of the input or None)
+        with self._mutex:
+            executor = self.executor
+            slots = self.slots
+
+        start = time.time()
+        if executor is None:
+            (layer_count, num_bytes, digest) = preprocess_file(src_path, dst_path, hash_input)
+        else:
+            (layer_count, num_bytes, digest) = self.preprocess_in_pool(executor, slots, src_path, dst_path, hash_input)
+
+        seconds = time.time() - start
+        mb_per_second = num_bytes / 1024.0 / 1024.0 / seconds if seconds > 0 else None
+        _logger.info('Preprocessed {} ({} bytes) in {:.1f}s'.format(os.path.basename(dst_path), num_bytes, seconds))
+        with self._mutex:
+            self.files += 1
+            self.bytes += num_bytes
+            self.seconds += seconds
+            self.recent.append(dict(file=os.path.basename(dst_path), bytes=num_bytes, seconds=seconds, mb_per_second=mb_per_second))
+        return (layer_count, digest)
+
+    def preprocess_in_pool(self, executor, slots, src_path, dst_path, hash_input):
+        # The worker writes to a temporary file of its own, so that it can't get in the way if it's given up on
+        tmp_path = hidden_tmp_path(dst_path, '.obico_preprocessing')
+        timeout = POOL_TIMEOUT_SECONDS + POOL_TIMEOUT_SECONDS_PER_MB * os.path.getsize(src_path) / 1024.0 / 1024.0
+        try:
+            with slots:
+                result = executor.submit(preprocess_file, src_path, tmp_path, hash_input).result(timeout=timeout)
+            os.rename(tmp_path, dst_path)
+            move_sidecar(tmp_path, dst_path)
+            return result
+        except TimeoutError:
+            _logger.error('Preprocessing pool took longer than {:.0f}s. Preprocessing in-process'.format(timeout))
+        except BrokenProcessPool:   # A worker process was killed, e.g. by the OOM killer. Not worth failing the upload for
+            _logger.exception('Preprocessing pool is broken. Preprocessing in-process')
+
+        with self._mutex:
+            if self.executor is executor:   # Start over with new worker processes
+                self.executor = None
+                self.configure(True, self.workers)
+        terminate_workers(executor)     # So that the one given up on doesn't keep writing to tmp_path
+        for path in (tmp_path, sidecar_path(tmp_path)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return preprocess_file(src_path, dst_path, hash_input)
+
+    def as_dict(self):
+        with self._mutex:
+            return dict(
+                enabled=self.executor is not None,
+                workers=self.workers,
+                files=self.files,
+                bytes=self.bytes,
+                avg_mb_per_second=self.bytes / 1024.0 / 1024.0 / self.seconds if self.seconds > 0 else None,
+                recent=list(self.recent),
+            )
+
+# Poor-man's singleton
+preprocessing_pool = PreprocessingPool()
+
+
+class PreprocessedFileWrapper(octoprint.filemanager.util.AbstractFileWrapper):
+    # Preprocessed by the pool straight into the destination file.
+    # For uploads that are already a file on disk (src_path), or others (spool_from, e.g. from FileDownloader), which are saved to a temporary file first.
+
+    def __init__(self, filename, src_path, plugin, file_path, digest=None, spool_from=None):
+        octoprint.filemanager.util.AbstractFileWrapper.__init__(self, filename)
+        self.src_path = src_path
+        self.plugin = plugin
+        self.file_path = file_path
+        self.digest = digest
+        self.spool_from = spool_from
+
+    def save(self, path, permissions=None):
+        if self.spool_from is None:
+            return self.save_preprocessed(self.src_path, path, permissions)
+
+        src_path = hidden_tmp_path(path, '.obico_spool')
+        try:
+            self.spool_from.save(src_path)
+            self.save_preprocessed(src_path, path, permissions)
+        finally:
+            os.remove(src_path)
+
+    def save_preprocessed(self, src_path, path, permissions):
+        hash_input = self.digest is None and preprocess_cache.enabled()
+        (layer_count, digest) = preprocessing_pool.preprocess(src_path, path, hash_input=hash_input)
+        if self.digest or digest:
+            preprocess_cache.store(self.digest or digest, path, layer_count)
+
+        if permissions is None:
+            permissions = self.DEFAULT_PERMISSIONS & ~octoprint.filemanager.util.UMASK
+        os.chmod(path, permissions)
+
+        self.plugin._file_manager.set_additional_metadata('local', self.file_path, 'obico', {"totalLayerCount": layer_count}, overwrite=True)
+
+    def stream(self):
+        input_stream = self.spool_from.stream() if self.spool_from is not None else open(self.src_path, 'rb')
+        return GcodePreProcessor(input_stream, self.plugin, self.file_path, digest=self.digest)
+
+
+class CachingStreamWrapper(octoprint.filemanager.util.StreamWrapper):
+    # Adds the output to the preprocess cache, once it's been saved in full and the file is closed.
+
+    def __init__(self, filename, preprocessor):
+        octoprint.filemanager.util.StreamWrapper.__init__(self, filename, preprocessor)
+        self.preprocessor = preprocessor
+
+    def save(self, path, permissions=None):
+        octoprint.filemanager.util.StreamWrapper.save(self, path, permissions)
+        self.preprocessor.close()   # Saves totalLayerCount and the layer index, if that hasn't happened yet
+
+        digest = self.preprocessor.input_digest()
+        if digest:
+            preprocess_cache.store(digest, path, self.preprocessor.layer_count)
+
+
+class CachedFileWrapper(octoprint.filemanager.util.AbstractFileWrapper):
+    # For uploads that have been preprocessed before. Copied from the preprocess cache.
+
+    def __init__(self, filename, digest, file_object, plugin, file_path):
+        octoprint.filemanager.util.AbstractFileWrapper.__init__(self, filename)
+        self.digest = digest
+        self.file_object = file_object
+        self.plugin = plugin
+        self.file_path = file_path
+
+    def save(self, path, permissions=None):
+        (found, layer_count) = preprocess_cache.restore(self.digest, path)
+        if not found:   # Evicted since. Preprocess after all
+            CachingStreamWrapper(self.filename, self.stream()).save(path, permissions)
+            return
+
+        if permissions is None:
+            permissions = self.DEFAULT_PERMISSIONS & ~octoprint.filemanager.util.UMASK
+        os.chmod(path, permissions)
+
+        self.plugin._file_manager.set_additional_metadata('local', self.file_path, 'obico', {"totalLayerCount": layer_count}, overwrite=True)
+
+    def stream(self):
+        return GcodePreProcessor(self.file_object.stream(), self.plugin, self.file_path, digest=self.digest)
+
+
+def content_hash(file_object):
+    # Return: the hash of the upload if it can be had without consuming it, or None
+    if isinstance(file_object, octoprint.filemanager.util.DiskFileWrapper):
+        return file_hash(file_object.path)
+    if hasattr(file_object, 'content_hash'):
+        return file_object.content_hash()
+    return None
 
 
 ## A Wrapper so that the preprocessor can access the plugin itself.
@@ -70,4 +393,14 @@ class GcodePreProcessorWrapper:
         filename = file_object.filename
         if not octoprint.filemanager.valid_file_type(filename, type="gcode"):
             return file_object
+
+        digest = content_hash(file_object) if preprocess_cache.enabled() else None
+        if digest and preprocess_cache.contains(digest):
+            return CachedFileWrapper(filename, digest, file_object, self.plugin, path)
+        if preprocessing_pool.enabled():
+            if isinstance(file_object, octoprint.filemanager.util.DiskFileWrapper):
+                return PreprocessedFileWrapper(filename, file_object.path, self.plugin, path, digest=digest)
+            return PreprocessedFileWrapper(filename, None, self.plugin, path, digest=digest, spool_from=file_object)
+        if preprocess_cache.enabled():
+            return CachingStreamWrapper(filename, GcodePreProcessor(file_object.stream(), self.plugin, path, digest=digest, hash_input=True))
         return octoprint.filemanager.util.StreamWrapper(filename, GcodePreProcessor(file_object.stream(), self.plugin, path))
@@ -16,7 +16,7 @@ except ImportError:
     import Queue as queue
 
 from .utils import ExpoBackoff, pi_version, is_port_open, wait_for_port, wait_for_port_to_close, run_in_thread
-from .ws import WebSocketClient
+from .ws import create_ws_client
 from .lib import alert_queue
 from .janus_config_builder import RUNTIME_JANUS_ETC_DIR
 
@@ -77,7 +77,7 @@ class JanusConn:
         def on_close(ws, **kwargs):
             _logger.warn('Janus WS connection closed!')
 
-        self.janus_ws = WebSocketClient(
+        self.janus_ws = create_ws_client(
             'ws://{}:{}/'.format(self.janus_server, self.janus_port),
             on_ws_msg=self.process_janus_msg,
             on_ws_close=on_close,
@@ -0,0 +1,115 @@
+# coding=utf-8
+
+### Decides whether and how to compress a tunneled response body, and keeps stats per content type to tune it.
+
+import bz2
+import threading
+import time
+import zlib
+try:
+    import lzma
+except ImportError:   # Python 2
+    lzma = None
+
+# Not worth compressing, or already compressed
+INCOMPRESSIBLE_TYPES = (
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/avif',
+    'video/', 'audio/',
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2',
+    'application/x-xz', 'application/x-7z-compressed', 'application/x-rar-compressed',
+    'font/woff', 'font/woff2', 'application/font-woff',
+)
+# No need to sample, these always compress well
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/javascript', 'application/x-javascript',
+    'application/xml', 'image/svg+xml', 'image/bmp',
+)
+
+MIN_SIZE = 1000
+SAMPLE_SIZE = 4096
+SAMPLE_MIN_SIZE = 16 * 1024     # Smaller bodies of unknown types are just compressed. Sampling would cost as much
+SAMPLE_MAX_RATIO = 0.9          # Don't bother compressing if a sample doesn't shrink by at least 10%
+
+DEFAULT_CODEC = 'zlib'
+
+thread_time = getattr(time, 'thread_time', time.process_time)   # Tunnel requests are handled by several threads
+
+
+def available_codecs():
+    return ('zlib', 'bz2', 'lzma') if lzma else ('zlib', 'bz2')
+
+
+def compress(codec, level, content):
+    if codec == 'bz2':
+        return bz2.compress(content, level or 9)
+    if codec == 'lzma':
+        return lzma.compress(content, preset=level)
+    return zlib.compress(content, -1 if level is None else level)
+
+
+def compressobj(codec, level):
+    # Return: an object with compress(data) and flush(), like zlib.compressobj
+    if codec == 'bz2':
+        return bz2.BZ2Compressor(level or 9)
+    if codec == 'lzma':
+        return lzma.LZMACompressor(preset=level)
+    return zlib.compressobj(-1 if level is None else level)
+
+
+def media_type(content_type):
+    return (content_type or '').split(';')[0].strip().lower() or 'unknown'
+
+
+class CompressionPolicy:
+
+    def __init__(self, codec=DEFAULT_CODEC, level=None, min_size=MIN_SIZE):
+        self._mutex = threading.RLock()
+        self.codec = codec if codec in available_codecs() else DEFAULT_CODEC
+        self.level = level
+        self.min_size = min_size
+        self.stats = dict()
+
+    def should_compress(self, content_type, content_encoding, size=None, sample=None):
+        # size: None if unknown (streamed). sample: the beginning of the body, if available.
+        if content_encoding and content_encoding.lower() != 'identity':
+            return False
+        if size is not None and size < self.min_size:
+            return False
+
+        mtype = media_type(content_type)
+        if mtype.startswith(INCOMPRESSIBLE_TYPES):
+            return False
+        if mtype.startswith(COMPRESSIBLE_TYPES):
+            return True
+
+        if sample is not None and size is not None and size >= SAMPLE_MIN_SIZE:
+            sample = sample[:SAMPLE_SIZE]
+            return len(zlib.compress(sample, 1)) < len(sample) * SAMPLE_MAX_RATIO
+
+        return True
+
+    def compress(self, content, content_type, content_encoding):
+        # Return: (payload, codec). codec is None if the content is left uncompressed
+        start = thread_time()    # Includes the cost of sampling
+        if not self.should_compress(content_type, content_encoding, size=len(content), sample=content):
+            self.record(content_type, len(content), len(content), thread_time() - start, compressed=False)
+            return (content, None)
+
+        payload = compress(self.codec, self.level, content)
+        self.record(content_type, len(content), len(payload), thread_time() - start)
+        return (payload, self.codec)
+
+    def record(self, content_type, bytes_in, bytes_out, cpu_seconds, compressed=True):
+        with self._mutex:
+            stat = self.stats.setdefault(media_type(content_type), dict(
+                responses=0, compressed=0, bytes_in=0, bytes_out=0, cpu_seconds=0.0))
+            stat['responses'] += 1
+            if compressed:
+                stat['compressed'] += 1
+            stat['bytes_in'] += bytes_in
+            stat['bytes_out'] += bytes_out
+            stat['cpu_seconds'] += cpu_seconds
+
+    def as_dict(self):
+        with self._mutex:
+            return dict(codec=self.codec, level=self.level, by_content_type={k: dict(v) for (k, v) in self.stats.items()})
@@ -0,0 +1,103 @@
+# coding=utf-8
+import logging
+import threading
+import time
+
+_logger = logging.getLogger('octoprint.plugins.obico')
+
+
+# Calls `fn` on its own thread (see run) once something has changed, as signaled by trigger().
+#
+#   min_latency: fn waits until there have been no new triggers for this long, so that a burst of changes is sent once.
+#   max_latency: but it doesn't wait any longer than this after the first trigger, even if the changes keep coming.
+#   heartbeat:   seconds (or a function that returns the seconds). fn is also called if it hasn't been for this long. None for never.
+class Debouncer:
+
+    def __init__(self, fn, min_latency, max_latency, heartbeat=None, on_error=None):
+        self._mutex = threading.RLock()
+        self._wakeup = threading.Condition(self._mutex)
+        self.fn = fn
+        self.min_latency = min_latency
+        self.max_latency = max(min_latency, max_latency)
+        self.heartbeat = heartbeat
+        self.on_error = on_error
+        self.stopped = False
+
+        self.first_trigger_ts = None    # None when nothing has changed since fn was last called
+        self.last_trigger_ts = None
+        self.last_called_ts = time.time()
+
+        self.triggers = 0
+        self.calls = 0
+        self.heartbeats = 0
+        self.latency_total = 0.0
+
+    def trigger(self):
+        with self._mutex:
+            now = time.time()
+            self.triggers += 1
+            self.last_trigger_ts = now
+            if self.first_trigger_ts is None:
+                self.first_trigger_ts = now
+                self._wakeup.notify()
+
+    def wake(self):
+        # The heartbeat may have changed. Work out again when fn is due
+        with self._mutex:
+            self._wakeup.notify()
+
+    def called_elsewhere(self):
+        # fn's job has just been done some other way (e.g. an event sent status). The heartbeat is due that much later
+        with self._mutex:
+            self.last_called_ts = time.time()
+            self._wakeup.notify()
+
+    def stop(self):
+        with self._mutex:
+            self.stopped = True
+            self._wakeup.notify()
+
+    def due_ts(self):
+        with self._mutex:
+            if self.first_trigger_ts is not None:
+                return min(self.last_trigger_ts + self.min_latency, self.first_trigger_ts + self.max_latency)
+
+            heartbeat = self.heartbeat() if callable(self.heartbeat) else self.heartbeat
+            return self.last_called_ts + heartbeat if heartbeat else None
+
+    def run(self):
+        while True:
+            with self._mutex:
+                if self.stopped:
+                    return
+
+                due = self.due_ts()
+                now = time.time()
+                if due is None or due > now:
+                    self._wakeup.wait(None if due is None else due - now)
+                    continue
+
+                if self.first_trigger_ts is None:
+                    self.heartbeats += 1
+                else:
+                    self.latency_total += now - self.first_trigger_ts
+                self.calls += 1
+                self.first_trigger_ts = None
+                self.last_called_ts = now
+
+            try:
+                self.fn()
+            except Exception:
+                _logger.exception('Debounced call to {} failed'.format(getattr(self.fn, '__name__', self.fn)))
+                if self.on_error:
+                    self.on_error()
+
+    def as_dict(self):
+        with self._mutex:
+            triggered_calls = self.calls - self.heartbeats
+            return dict(
+                triggers=self.triggers,
+                calls=self.calls,
+                heartbeats=self.heartbeats,
+                avg_latency_seconds=self.latency_total / triggered_calls if triggered_calls else None,
+            )
@@ -0,0 +1,102 @@
+# coding=utf-8
+
+### OctoPrint's metadata of the file being printed, cached so that it isn't read from .metadata.json for every status update.
+#   Entries are keyed by (origin, path), and are only good for as long as the file's mtime doesn't change.
+#   The plugin also invalidates them on file and metadata events (see FILE_METADATA_EVENTS).
+#
+#   Each version of the metadata has a version id (a hash of its content), sent as `file_metadata_version` in status.
+#   The full metadata then only needs to be sent to the server when that changes (opt-in with the `file_metadata_versioning` setting).
+#   With `status_delta_encoding` on, deltas already leave it out while it's unchanged, and it isn't elided.
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+_logger = logging.getLogger('octoprint.plugins.obico')
+
+FILE_METADATA_EVENTS = (
+    'FileAdded', 'FileRemoved', 'FileMoved', 'FolderRemoved', 'FolderMoved',
+    'MetadataAnalysisFinished', 'MetadataStatisticsUpdated',
+)
+
+
+def metadata_version(metadata):
+    return hashlib.sha1(json.dumps(metadata, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:12]
+
+
+class FileMetadataCache:
+
+    def __init__(self):
+        self._mutex = threading.RLock()
+        self.entries = dict()     # (origin, path) -> (mtime, metadata, version)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_manager, origin, path):
+        # Return: (metadata, version)
+        mtime = self._mtime(file_manager, origin, path)
+        with self._mutex:
+            entry = self.entries.get((origin, path))
+            if entry is not None and entry[0] == mtime:
+                self.hits += 1
+                return entry[1:]
+            self.misses += 1
+
+        metadata = file_manager._storage_managers.get(origin).get_metadata(path) or {}
+        version = metadata_version(metadata)
+        with self._mutex:
+            self.entries[(origin, path)] = (mtime, metadata, version)
+        return (metadata, version)
+
+    def invalidate(self, origin=None, path=None):
+        # Without origin and path, e.g. a folder has been moved: everything
+        with self._mutex:
+            if origin and path:
+                self.entries.pop((origin, path), None)
+            else:
+                self.entries.clear()
+
+    def as_dict(self):
+        with self._mutex:
+            return dict(entries=len(self.entries), hits=self.hits, misses=self.misses)
+
+    def _mtime(self, file_manager, origin, path):
+        if origin != 'local':   # Not a file we can stat. Good until invalidated
+            return None
+        try:
+            return os.path.getmtime(file_manager.path_on_disk(origin, path))
+        except (OSError, IOError):
+            return None
+
+
+class FileMetadataElider:
+    # Per server connection: leaves file_metadata out of status if the server already has that version.
+
+    def __init__(self):
+        self._mutex = threading.RLock()
+        self.sent_version = None
+
+    def reset(self):
+        # E.g. reconnected. The next status has the full metadata
+        with self._mutex:
+            self.sent_version = None
+
+    def elide(self, data):
+        status = data.get('status')
+        if not status or 'file_metadata_version' not in status:
+            return data
+
+        with self._mutex:
+            version = status['file_metadata_version']
+            if version != self.sent_version or 'event' in data:   # Print events always have it all
+                self.sent_version = version
+                return data
+
+        elided = dict(data)
+        elided['status'] = {k: v for (k, v) in status.items() if k != 'file_metadata'}
+        return elided
+
+# Poor-man's singleton
+file_metadata_cache = FileMetadataCache()
@@ -0,0 +1,32 @@
+# coding=utf-8
+
+### Byte-level matching of the layer change comments that slicers put in G-code.
+#   Same results as decoding each line, lstrip()-ing it and matching it against the layer indicator patterns, without the decoding.
+
+import re
+
+# One regex for all the slicers, to be matched right after the leading ';':
+#   Cura:                   ;LAYER:12
+#   Simplify3D:             ; layer 12, ...
+#   Slic3r/PrusaSlicer:     ;BEFORE_LAYER_CHANGE
+#   Almost everyone else:   ; BEGIN_LAYER_OBJECT, ;LAYER:12, ; <layer 12>, ...
+LAYER_INDICATOR_RE = re.compile(br'(?:(?: BEGIN_|BEFORE_)+LAYER_(?:CHANGE|OBJECT)|LAYER:[0-9]+| <?layer [0-9]+)')
+
+# What str.lstrip() strips and is ASCII. Everything else it strips is non-ASCII, i.e. starts with a byte >= 0x80 in UTF-8.
+ASCII_WHITESPACE = b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'
+
+# For searching a whole buffer at once: the start of every line that lstrip_line or is_layer_indicator would do anything about.
+# I.e. blank lines, lines with leading whitespace (or what may be unicode whitespace), and layer indicators.
+LINE_TO_PROCESS_RE = re.compile(br'^(?:[ \t\n\r\x0b\x0c\x1c-\x1f\x80-\xff]|;' + LAYER_INDICATOR_RE.pattern + br')', re.MULTILINE)
+
+
+def lstrip_line(line):
+    line = line.lstrip(ASCII_WHITESPACE)
+    if line[:1] >= b'\x80':    # Possibly unicode whitespace, such as a no-break space. Rare enough to take the slow path
+        line = line.decode('utf-8').lstrip().encode('utf-8')
+    return line
+
+
+def is_layer_indicator(line):
+    # line: already lstrip'ed
+    return line[:1] == b';' and LAYER_INDICATOR_RE.match(line, 1) is not None
@@ -0,0 +1,164 @@
+# coding=utf-8
+
+### Per-layer index of a preprocessed G-code file: byte offset, line number, Z height and cumulative extrusion at the start of each layer.
+#   Built while the upload is preprocessed, and saved in a small binary sidecar next to the G-code file:
+#
+#   b'OBLI' | version (u8) | layer count (u32) | offsets (i64 * n) | lines (i64 * n) | z (f64 * n) | extrusion (f64 * n)
+#
+#   All little-endian. Layer n (1-based, as in M117 OBICO_LAYER_INDICATOR n) is at position n - 1. z is NaN if no Z move was found.
+
+import logging
+import math
+import os
+import re
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+
+_logger = logging.getLogger('octoprint.plugins.obico')
+
+MAGIC = b'OBLI'
+VERSION = 1
+HEADER = struct.Struct('<4sBI')
+SIDECAR_SUFFIX = '.obico_layers'
+
+Z_RE = re.compile(br'^G[01] [^\n;]*?Z(-?[0-9]*\.?[0-9]+)', re.MULTILINE)
+EXTRUSION_MOVE_RE = re.compile(br'^G[01] [^\n;E]*E(-?[0-9]*\.?[0-9]+)', re.MULTILINE)
+# E resets and extruder mode (M82 absolute, M83 relative). Rare, so the moves in-between can be handled in bulk
+EXTRUSION_MODE_RE = re.compile(br'^(?:G92 [^\n;E]*E(-?[0-9]*\.?[0-9]+)|M8([23]))', re.MULTILINE)
+
+
+def sidecar_path(gcode_path):
+    (folder, filename) = os.path.split(gcode_path)
+    return os.path.join(folder, '.' + filename + SIDECAR_SUFFIX)    # Hidden, so that OctoPrint doesn't list it
+
+
+def remove_sidecar(gcode_path):
+    try:
+        os.remove(sidecar_path(gcode_path))
+    except OSError:
+        pass
+
+
+def move_sidecar(src_gcode_path, dst_gcode_path):
+    try:
+        os.rename(sidecar_path(src_gcode_path), sidecar_path(dst_gcode_path))
+    except OSError:
+        pass
+
+
+class LayerIndex:
+
+    def __init__(self):
+        self.offsets = array('q')
+        self.lines = array('q')
+        self.z = array('d')
+        self.extrusion = array('d')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, offset, line, z, extrusion):
+        self.offsets.append(offset)
+        self.lines.append(line)
+        self.z.append(z)
+        self.extrusion.append(extrusion)
+
+    def layer(self, layer_num):
+        # Return: dict(offset, line, z, extrusion) of layer `layer_num` (1-based), or None if out of range
+        i = layer_num - 1
+        if i < 0 or i >= len(self.offsets):
+            return None
+        z = self.z[i]
+        return dict(offset=self.offsets[i], line=self.lines[i], z=None if math.isnan(z) else z, extrusion=self.extrusion[i])
+
+    def layer_at_offset(self, offset):
+        # Return: number of the layer the byte at `offset` is in. 0 if it's before the first layer
+        return bisect_right(self.offsets, offset)
+
+    def save(self, path):
+        arrays = [self.offsets, self.lines, self.z, self.extrusion]
+        if sys.byteorder != 'little':
+            arrays = [array(a.typecode, a) for a in arrays]
+            for a in arrays:
+                a.byteswap()
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(self.offsets)))
+            for a in arrays:
+                f.write(a.tobytes())
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        # Return: None if there's no valid index at path
+        try:
+            with open(path, 'rb') as f:
+                (magic, version, count) = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC or version != VERSION:
+                    return None
+
+                index = cls()
+                for a in (index.offsets, index.lines, index.z, index.extrusion):
+                    a.frombytes(f.read(count * a.itemsize))
+                    if len(a) != count:
+                        return None
+                    if sys.byteorder != 'little':
+                        a.byteswap()
+                return index
+        except (IOError, OSError, struct.error):
+            return None
+
+
+class LayerIndexBuilder:
+    # Fed with the preprocessor's output, in order.
+
+    def __init__(self):
+        self.index = LayerIndex()
+        self.output_bytes = 0
+        self.output_lines = 0
+        self.waiting_for_z = False
+        self.relative_extrusion = False
+        self.last_e = 0.0
+        self.extrusion = 0.0
+
+    def layer_started(self):
+        # Called right before the layer indicator line is fed
+        self.index.append(self.output_bytes, self.output_lines + 1, float('nan'), self.extrusion)
+        self.waiting_for_z = True
+
+    def feed(self, data):
+        if self.waiting_for_z:
+            m = Z_RE.search(data)
+            if m:
+                self.index.z[-1] = float(m.group(1))
+                self.waiting_for_z = False
+
+        self.track_extrusion(data)
+        self.output_bytes += len(data)
+        self.output_lines += data.count(b'\n')
+
+    def track_extrusion(self, data):
+        pos = 0
+        for m in EXTRUSION_MODE_RE.finditer(data):
+            self.track_moves(data, pos, m.start())
+            (reset_e, mode) = m.groups()
+            if reset_e is not None:
+                self.last_e = float(reset_e)
+            else:
+                self.relative_extrusion = mode == b'3'
+            pos = m.end()
+        self.track_moves(data, pos, len(data))
+
+    def track_moves(self, data, start, end):
+        values = EXTRUSION_MOVE_RE.findall(data, start, end)
+        if not values:
+            return
+        if self.relative_extrusion:
+            self.extrusion += sum(map(float, values))
+        else:   # Only the last position matters
+            last_e = float(values[-1])
+            self.extrusion += last_e - self.last_e
+            self.last_e = last_e
@@ -0,0 +1,94 @@
+# coding=utf-8
+
+### A requests session with a bounded keep-alive connection pool that keeps track of how often connections are reused.
+#   requests.Session and its connection pools are thread-safe, so one instance can be shared by all threads.
+#   Like one-off requests, it doesn't keep cookies set by the server between requests.
+
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+try:
+    from http.cookiejar import DefaultCookiePolicy
+except ImportError:
+    from cookielib import DefaultCookiePolicy
+
+DEFAULT_POOL_SIZE = 4
+
+
+class PooledSession:
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE):
+        self._mutex = threading.RLock()
+        self.session = requests.Session()
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.adapter = None
+        self.requests = 0
+        self.new_connections = 0
+        self.handshake_seconds_total = 0.0
+        self.last_handshake_seconds = None
+        self.configure(pool_size)
+
+    def configure(self, pool_size):
+        with self._mutex:
+            self.pool_size = pool_size
+            old_adapter = self.adapter
+            self.adapter = _MeteredHTTPAdapter(self, pool_connections=pool_size, pool_maxsize=pool_size)
+            self.session.mount('http://', self.adapter)
+            self.session.mount('https://', self.adapter)
+            if old_adapter is not None:
+                old_adapter.close()     # Its idle connections. Those in use are closed as they are released
+
+    def request(self, method, url, **kwargs):
+        with self._mutex:
+            self.requests += 1
+        return self.session.request(method, url, **kwargs)
+
+    def record_new_connection(self, handshake_seconds):
+        with self._mutex:
+            self.new_connections += 1
+            self.last_handshake_seconds = handshake_seconds
+            self.handshake_seconds_total += handshake_seconds
+
+    def as_dict(self):
+        with self._mutex:
+            return dict(
+                pool_size=self.pool_size,
+                requests=self.requests,
+                new_connections=self.new_connections,
+                reused_connections=max(self.requests - self.new_connections, 0),
+                avg_handshake_seconds=self.handshake_seconds_total / self.new_connections if self.new_connections else None,
+                last_handshake_seconds=self.last_handshake_seconds,
+            )
+
+
+class _MeteredHTTPAdapter(HTTPAdapter):
+
+    def __init__(self, pooled_session, **kwargs):
+        self.pooled_session = pooled_session   # Has to be set before super().__init__, which calls init_poolmanager
+        super(_MeteredHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_MeteredHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _metered_pool_cls(HTTPConnectionPool, self.pooled_session),
+            'https': _metered_pool_cls(HTTPSConnectionPool, self.pooled_session),
+        }
+
+
+def _metered_pool_cls(pool_cls, pooled_session):
+
+    class MeteredConnection(pool_cls.ConnectionCls):
+
+        def connect(self):
+            # TCP connect + TLS handshake. Only happens when there is no idle connection in the pool to reuse
+            start = time.time()
+            super(MeteredConnection, self).connect()
+            pooled_session.record_new_connection(time.time() - start)
+
+    class MeteredConnectionPool(pool_cls):
+        ConnectionCls = MeteredConnection
+
+    return MeteredConnectionPool
@@ -0,0 +1,208 @@
+# coding=utf-8
+
+### Content-addressed cache of preprocessed G-code (opt-in with the `preprocessing_cache_mb` setting), so that re-uploading (or re-downloading) the same file doesn't preprocess it again.
+#   Keyed by the SHA-256 of the original upload and PREPROCESSOR_VERSION. Each entry is a few files in the cache folder:
+#
+#   <key>.gcode                         the preprocessed G-code
+#   .<key>.gcode.obico_layers           its layer index, if it has layers
+#   <key>.json                          {"totalLayerCount": ...}. Written last, so an entry without it is incomplete
+#
+#   Least recently used entries are evicted when the folder gets over max_bytes. Entries of older versions are never hit again, and age out.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from .layer_index import sidecar_path, remove_sidecar
+
+_logger = logging.getLogger('octoprint.plugins.obico')
+
+HASH_READ_SIZE = 1024 * 1024
+
+# Bump whenever GcodePreProcessor's output (or the layer index) changes, so that the output of the old version isn't served anymore
+PREPROCESSOR_VERSION = 1
+
+
+def new_hash():
+    return hashlib.sha256()
+
+
+def bytes_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def entry_key(digest):
+    return '{}-v{}'.format(digest, PREPROCESSOR_VERSION)
+
+
+def file_hash(path):
+    h = new_hash()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(HASH_READ_SIZE), b''):
+            h.update(data)
+    return h.hexdigest()
+
+
+class PreprocessCache:
+
+    def __init__(self):
+        self._mutex = threading.RLock()
+        self.folder = None
+        self.max_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def configure(self, folder, max_bytes):
+        with self._mutex:
+            self.folder = folder if max_bytes > 0 else None
+            self.max_bytes = max_bytes
+            if self.folder and not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+
+    def enabled(self):
+        with self._mutex:
+            return self.folder is not None
+
+    def contains(self, digest):
+        with self._mutex:
+            found = self.folder is not None and os.path.exists(self._meta_path(entry_key(digest)))
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return found
+
+    def restore(self, digest, dst_path):
+        # Copies the cached output to dst_path. Return: (True, totalLayerCount), or (False, None) if it's no longer there
+        with self._mutex:
+            if self.folder is None:
+                return (False, None)
+            key = entry_key(digest)
+            (gcode_path, meta_path) = (self._gcode_path(key), self._meta_path(key))
+
+        try:
+            with open(meta_path) as f:
+                layer_count = json.load(f)['totalLayerCount']
+            shutil.copyfile(gcode_path, dst_path)
+            if os.path.exists(sidecar_path(gcode_path)):
+                shutil.copyfile(sidecar_path(gcode_path), sidecar_path(dst_path))
+            else:
+                remove_sidecar(dst_path)
+            os.utime(meta_path, None)   # For LRU eviction
+            return (True, layer_count)
+        except (IOError, OSError, ValueError, KeyError):
+            _logger.warning('Preprocessed G-code {} is gone from the cache'.format(digest))
+            return (False, None)
+
+    def store(self, digest, gcode_path, layer_count):
+        # gcode_path: the preprocessed G-code, complete and closed, with its layer index sidecar if any
+        with self._mutex:
+            (folder, max_bytes) = (self.folder, self.max_bytes)
+        if folder is None:
+            return
+
+        # Copied to temporary files without holding the lock, as it may take a while. Moved into place under the lock
+        key = entry_key(digest)
+        tmp_paths = []
+        try:
+            if os.path.getsize(gcode_path) > max_bytes:
+                return
+
+            tmp_gcode_path = self._tmp_copy(folder, gcode_path, tmp_paths)
+            tmp_sidecar_path = self._tmp_copy(folder, sidecar_path(gcode_path), tmp_paths) if os.path.exists(sidecar_path(gcode_path)) else None
+            (fd, tmp_meta_path) = tempfile.mkstemp(dir=folder, suffix='.tmp')
+            tmp_paths.append(tmp_meta_path)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'totalLayerCount': layer_count}, f)
+
+            with self._mutex:
+                if self.folder != folder:   # Reconfigured in the meantime
+                    return
+                cached_path = self._gcode_path(key)
+                os.rename(tmp_gcode_path, cached_path)
+                if tmp_sidecar_path:
+                    os.rename(tmp_sidecar_path, sidecar_path(cached_path))
+                else:
+                    remove_sidecar(cached_path)
+                os.rename(tmp_meta_path, self._meta_path(key))
+                self.stores += 1
+                self.evict()
+        except (IOError, OSError):
+            _logger.exception('Failed to cache preprocessed G-code {}'.format(digest))
+            self.remove(key)
+        finally:
+            for path in tmp_paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _tmp_copy(self, folder, path, tmp_paths):
+        (fd, tmp_path) = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        os.close(fd)
+        tmp_paths.append(tmp_path)
+        shutil.copyfile(path, tmp_path)
+        return tmp_path
+
+    def remove(self, key):
+        with self._mutex:
+            for path in (self._meta_path(key), self._gcode_path(key), sidecar_path(self._gcode_path(key))):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def evict(self):
+        with self._mutex:
+            entries = self.entries()
+            total = sum(size for (_, _, size) in entries)
+            for (_, key, size) in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self.remove(key)
+                total -= size
+                self.evictions += 1
+
+    def entries(self):
+        # Return: [(last used ts, key, size)]
+        entries = []
+        for name in os.listdir(self.folder):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            paths = (self._meta_path(key), self._gcode_path(key), sidecar_path(self._gcode_path(key)))
+            try:
+                entries.append((os.path.getmtime(paths[0]), key, sum(os.path.getsize(p) for p in paths if os.path.exists(p))))
+            except OSError:
+                pass
+        return entries
+
+    def as_dict(self):
+        with self._mutex:
+            entries = self.entries() if self.folder else []
+            return dict(
+                enabled=self.folder is not None,
+                entries=len(entries),
+                bytes=sum(size for (_, _, size) in entries),
+                max_bytes=self.max_bytes,
+                hits=self.hits,
+                misses=self.misses,
+                stores=self.stores,
+                evictions=self.evictions,
+            )
+
+    def _gcode_path(self, key):
+        return os.path.join(self.folder, key + '.gcode')
+
+    def _meta_path(self, key):
+        return os.path.join(self.folder, key + '.json')
+
+# Poor-man's singleton
+preprocess_cache = PreprocessCache()
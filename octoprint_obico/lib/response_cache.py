@@ -0,0 +1,183 @@
+# coding=utf-8
+
+### LRU cache of tunneled responses, mostly for OctoPrint's static assets (JS, CSS, fonts, images).
+#   Stores the body as it's sent to the server, i.e. already compressed, so a hit costs neither a local request nor compression.
+#   Follows Cache-Control: fresh entries are served as they are, stale ones are revalidated with the local server using ETag/Last-Modified.
+#   Entries are keyed by the tunnel (v1 requests with the plugin's own session, v2 with the browser's cookies) and the requester's Cookie,
+#   so a response is never served to a request with other credentials.
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from requests.structures import CaseInsensitiveDict
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+MAX_ENTRY_FRACTION = 0.25   # A single response can't take more than a quarter of the cache
+
+# Requests with these headers may get a response that is specific to the requester
+UNCACHEABLE_REQUEST_HEADERS = ('Authorization', 'X-Api-Key', 'Range')
+
+MAX_AGE_RE = re.compile(r'(?:^|,)\s*max-age\s*=\s*"?(\d+)"?', re.IGNORECASE)
+
+
+class CacheEntry:
+
+    def __init__(self, status, headers, fields, vary_values, expires_ts, size):
+        self.status = status
+        self.headers = headers
+        self.fields = fields    # 'compressed', 'content', ... as sent to the server
+        self.vary_values = vary_values
+        self.expires_ts = expires_ts
+        self.size = size
+
+    @property
+    def etag(self):
+        return self.headers.get('ETag')
+
+    @property
+    def last_modified(self):
+        return self.headers.get('Last-Modified')
+
+    def is_fresh(self):
+        return time.time() < self.expires_ts
+
+    def validators(self):
+        # Return: headers to revalidate this entry with the local server
+        validators = {}
+        if self.etag:
+            validators['If-None-Match'] = self.etag
+        if self.last_modified:
+            validators['If-Modified-Since'] = self.last_modified
+        return validators
+
+    def not_modified_for(self, req_headers):
+        # Return: True if the requester already has this exact response, per its conditional headers
+        req_headers = CaseInsensitiveDict(req_headers or {})
+        if_none_match = req_headers.get('If-None-Match')
+        if if_none_match is not None:
+            return self.etag is not None and (if_none_match.strip() == '*' or self.etag in [t.strip() for t in if_none_match.split(',')])
+        if_modified_since = req_headers.get('If-Modified-Since')
+        return if_modified_since is not None and if_modified_since == self.last_modified
+
+    def response_fields(self, req_headers):
+        if self.not_modified_for(req_headers):
+            headers = {k: v for (k, v) in self.headers.items() if k.lower() in ('etag', 'last-modified', 'cache-control', 'vary', 'date', 'expires')}
+            return {'status': 304, 'headers': headers, 'compressed': False, 'content': b''}
+
+        resp_data = {'status': self.status, 'headers': dict(self.headers)}
+        resp_data.update(self.fields)
+        return resp_data
+
+
+class TunnelResponseCache:
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self._mutex = threading.RLock()
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def cache_key(self, tunnel, method, path, params, req_headers):
+        # tunnel: which tunnel the request came through, e.g. 'v1'. Return: None if the request is not cacheable
+        if self.max_bytes <= 0 or method.lower() != 'get':
+            return None
+        req_headers = CaseInsensitiveDict(req_headers or {})
+        if any(h in req_headers for h in UNCACHEABLE_REQUEST_HEADERS):
+            return None
+        cookie = req_headers.get('Cookie')
+        cookie_hash = hashlib.sha1(cookie.encode('utf-8')).hexdigest() if cookie else None
+        try:
+            # Params with several values come as lists
+            items = params.items() if hasattr(params, 'items') else (params or ())
+            key = (tunnel, method.lower(), path, cookie_hash, tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for (k, v) in items)))
+            hash(key)
+            return key
+        except (TypeError, ValueError):     # Params we can't make a key of. Not cached
+            return None
+
+    def lookup(self, key, req_headers):
+        if key is None:
+            return None
+
+        with self._mutex:
+            entry = self.entries.get(key)
+            if entry is None or entry.vary_values != _vary_values(entry.headers, req_headers):
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            if entry.is_fresh():
+                self.hits += 1
+            return entry
+
+    def store(self, key, req_headers, status, headers, fields):
+        # headers: response headers, without Set-Cookie. Return: True if cached
+        if key is None or status != 200:
+            return False
+
+        headers = CaseInsensitiveDict(headers)
+        cache_control = headers.get('Cache-Control', '').lower()
+        if 'no-store' in cache_control or 'private' in cache_control or headers.get('Vary', '').strip() == '*':
+            return False
+
+        max_age = MAX_AGE_RE.search(cache_control)
+        max_age = int(max_age.group(1)) if max_age and 'no-cache' not in cache_control else 0
+        if max_age <= 0 and not headers.get('ETag') and not headers.get('Last-Modified'):
+            return False    # Can't be used without asking the local server, and can't be revalidated either
+
+        size = len(fields.get('content') or b'') + sum(len(k) + len(v) for (k, v) in headers.items())
+        if size > self.max_bytes * MAX_ENTRY_FRACTION:
+            return False
+
+        entry = CacheEntry(status, headers, fields, _vary_values(headers, req_headers), time.time() + max_age, size)
+        with self._mutex:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.bytes -= old_entry.size
+            self.entries[key] = entry
+            self.bytes += size
+            self.stores += 1
+
+            while self.bytes > self.max_bytes:
+                (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+        return True
+
+    def refresh(self, entry, not_modified_headers):
+        # The local server says the stale entry is still good (304)
+        not_modified_headers = CaseInsensitiveDict(not_modified_headers)
+        cache_control = not_modified_headers.get('Cache-Control', entry.headers.get('Cache-Control', '')).lower()
+        max_age = MAX_AGE_RE.search(cache_control)
+        with self._mutex:
+            entry.expires_ts = time.time() + (int(max_age.group(1)) if max_age and 'no-cache' not in cache_control else 0)
+            self.revalidated += 1
+
+    def as_dict(self):
+        with self._mutex:
+            return dict(
+                entries=len(self.entries),
+                bytes=self.bytes,
+                max_bytes=self.max_bytes,
+                hits=self.hits,
+                misses=self.misses,
+                revalidated=self.revalidated,
+                stores=self.stores,
+                evictions=self.evictions,
+            )
+
+
+def _vary_values(resp_headers, req_headers):
+    vary = resp_headers.get('Vary')
+    if not vary:
+        return ()
+    req_headers = CaseInsensitiveDict(req_headers or {})
+    return tuple(req_headers.get(h.strip()) for h in vary.split(','))
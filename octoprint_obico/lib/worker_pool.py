@@ -0,0 +1,94 @@
+# coding=utf-8
+
+### A fixed number of daemon worker threads with a bounded backlog.
+#   Unlike concurrent.futures.ThreadPoolExecutor, a full backlog rejects new work instead of queuing it without bound.
+
+import logging
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_logger = logging.getLogger('octoprint.plugins.obico')
+
+
+class WorkerPool:
+
+    def __init__(self, name, num_workers, backlog):
+        self._mutex = threading.RLock()
+        self.name = name
+        self.num_workers = num_workers
+        self._tasks = queue.Queue(maxsize=backlog)
+        self._workers = []
+
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.active = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.service_time_total = 0.0
+        self.service_time_max = 0.0
+
+    def submit(self, fn, *args, **kwargs):
+        # Return: True if the task is queued. False if the backlog is full.
+        self._start_workers()
+        try:
+            self._tasks.put_nowait((time.time(), fn, args, kwargs))
+        except queue.Full:
+            with self._mutex:
+                self.rejected += 1
+            return False
+
+        with self._mutex:
+            self.submitted += 1
+        return True
+
+    def as_dict(self):
+        with self._mutex:
+            return dict(
+                workers=self.num_workers,
+                active=self.active,
+                backlog=self._tasks.qsize(),
+                max_backlog=self._tasks.maxsize,
+                submitted=self.submitted,
+                rejected=self.rejected,
+                completed=self.completed,
+                avg_queue_wait_seconds=self.queue_wait_total / self.completed if self.completed else None,
+                max_queue_wait_seconds=self.queue_wait_max,
+                avg_service_seconds=self.service_time_total / self.completed if self.completed else None,
+                max_service_seconds=self.service_time_max,
+            )
+
+    def _start_workers(self):
+        with self._mutex:
+            while len(self._workers) < self.num_workers:
+                worker = threading.Thread(target=self._work_loop, name='{}-{}'.format(self.name, len(self._workers)))
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _work_loop(self):
+        while True:
+            (queued_ts, fn, args, kwargs) = self._tasks.get()
+            started_ts = time.time()
+            with self._mutex:
+                self.active += 1
+
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                _logger.exception('Uncaught exception in {} worker'.format(self.name))
+
+            finished_ts = time.time()
+            with self._mutex:
+                self.active -= 1
+                self.completed += 1
+                queue_wait = started_ts - queued_ts
+                service_time = finished_ts - started_ts
+                self.queue_wait_total += queue_wait
+                self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+                self.service_time_total += service_time
+                self.service_time_max = max(self.service_time_max, service_time)
@@ -32,7 +32,7 @@ class NozzleCam:
     def send_nozzlecam_jpeg(self, snapshot):
         if snapshot:
             files = {'pic': snapshot}
-            resp = server_request('POST', '/ent/api/nozzle_cam/pic/', self.plugin, timeout=60, files=files, skip_debug_logging=True, headers=self.plugin.auth_headers())
+            resp = server_request('POST', '/ent/api/nozzle_cam/pic/', self.plugin, files=files, skip_debug_logging=True, headers=self.plugin.auth_headers())
             _logger.debug('nozzle cam jpeg posted to server - {0}'.format(resp))
 
     def notify_server_nozzlecam_complete(self):
@@ -40,7 +40,7 @@ class NozzleCam:
             return
         try:
             data = {'nozzlecam_status': 'complete'}
-            server_request('POST', '/ent/api/nozzle_cam/first_layer_done/', self.plugin, timeout=60, data=data, headers=self.plugin.auth_headers())
+            server_request('POST', '/ent/api/nozzle_cam/first_layer_done/', self.plugin, data=data, headers=self.plugin.auth_headers())
             _logger.debug('server notified 1st layer is done')
         except Exception:
             _logger.error('Failed to notify 1st layer completed', exc_info=True)
@@ -56,7 +56,7 @@ class NozzleCam:
 
             # For Celestrius alpha testers
             printer_id = self.plugin.linked_printer.get('id')
-            ext_info = server_request('GET', f'/ent/api/printers/{printer_id}/ext/', self.plugin, timeout=60, headers=self.plugin.auth_headers()).json().get('ext', {})
+            ext_info = server_request('GET', f'/ent/api/printers/{printer_id}/ext/', self.plugin, headers=self.plugin.auth_headers()).json().get('ext', {})
             _logger.debug('Printer ext info: {}'.format(ext_info))
             nozzle_url = ext_info.get('nozzlecam_url', None)
             if not nozzle_url or len(nozzle_url) == 0:
@@ -4,6 +4,9 @@ import re
 
 _logger = logging.getLogger('octoprint.plugins.obico')
 
+# Positioning mode (G90 absolute, G91 relative) and extruder mode (M82 absolute, M83 relative)
+POSITIONING_MODE_RE = re.compile('(G9[01])|(M8[23])', flags=re.IGNORECASE)
+
 
 class PauseResumeGCodeSequence:
 
@@ -16,10 +19,14 @@ class PauseResumeGCodeSequence:
         self.last_m8x = 'M82'
 
     def track_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
+        m = POSITIONING_MODE_RE.match(cmd)
+        if not m:
+            return
+
         with self.mutex:
-            if re.match('G9[01]', cmd, flags=re.IGNORECASE):
+            if m.group(1):
                 self.last_g9x = cmd
-            if re.match('M8[23]', cmd, flags=re.IGNORECASE):
+            else:
                 self.last_m8x = cmd
 
     def script_hook(self, comm, script_type, script_name, *args, **kwargs):
@@ -1,9 +1,13 @@
 import flask
 import logging
 
-from .utils import server_request
+from .utils import server_request, server_session
 from .lib.error_stats import error_stats
 from .lib import alert_queue
+from .webcam_capture import jpeg_frame_cache
+from .gcode_preprocessor import preprocessing_pool
+from .lib.preprocess_cache import preprocess_cache
+from .lib.file_metadata_cache import file_metadata_cache
 
 _logger = logging.getLogger('octoprint.plugins.obico')
 
@@ -51,11 +55,23 @@ def on_api_command(plugin, command, data):
                     is_connected=plugin.ss and plugin.ss.connected(),
                     status_posted_to_server_ts=plugin.status_posted_to_server_ts,
                     bailed_because_tsd_plugin_running=plugin.bailed_because_tsd_plugin_running,
+                    message_queue=plugin.message_queue_to_server.as_dict(),
+                    http_session=server_session.as_dict(),
+                    tunnel=plugin.local_tunnel.as_dict() if plugin.local_tunnel else None,
+                    terminal_feed=plugin.gcode_hooks.terminal_feed.as_dict(),
+                    status_push=dict(
+                        client=plugin.client_status_debouncer.as_dict(),
+                        client_changes=plugin.client_status_filter.as_dict(),
+                        server=plugin.server_status_debouncer.as_dict(),),
                 ),
                 linked_printer=plugin.linked_printer,
                 streaming_status=dict(
-                    webrtc_streaming=webcam_streamer and not webcam_streamer.shutting_down,),
+                    webrtc_streaming=webcam_streamer and not webcam_streamer.shutting_down,
+                    jpeg_frame_cache=jpeg_frame_cache.as_dict(),),
                 error_stats=error_stats.as_dict(),
+                preprocessing=preprocessing_pool.as_dict(),
+                preprocess_cache=preprocess_cache.as_dict(),
+                file_metadata_cache=file_metadata_cache.as_dict(),
                 alerts=alert_queue.fetch_and_clear(),
             )
             if plugin._settings.get(["auth_token"]):     # Ask to opt in sentry only after wizard is done.
@@ -6,11 +6,16 @@ import os
 from octoprint.filemanager.analysis import QueueEntry
 
 from .utils import server_request, get_file_metadata
+from .lib.layer_index import LayerIndex, sidecar_path
+from .lib.file_metadata_cache import file_metadata_cache
 _logger = logging.getLogger('octoprint.plugins.obico')
 
 
 MAX_GCODE_DOWNLOAD_SECONDS = 30 * 60
 
+# Apparently printers like Prusa throws random temperatures here. This should be consistent with OctoPrint, which only keeps r"^(tool\d+|bed|chamber)$"
+TEMPERATURE_KEY_RE = re.compile(r'^(tool\d+|bed|chamber)$')
+
 class PrintJobTracker:
 
     def __init__(self):
@@ -18,8 +23,12 @@ class PrintJobTracker:
         self.current_print_ts = -1    # timestamp when current print started, acting as a unique identifier for a print
         self.obico_g_code_file_id = None
         self._file_metadata_cache = None
+        self._file_metadata_version = None
         self.current_layer_height = None
+        self.current_layer_z = None
+        self.layer_index = None
         self.gcode_downloading_started = None
+        self._temperature_keys = set()  # Keys that have passed TEMPERATURE_KEY_RE, for the printer connected. Random ones are not kept, so this stays small
 
     def on_event(self, plugin, event, payload):
 
@@ -35,7 +44,7 @@ class PrintJobTracker:
                 agent_signature='md5:{}'.format(md5_hash),
                 url = payload['path']
                 )
-            resp = server_request('POST', '/api/v1/octo/g_code_files/', plugin, timeout=60, data=g_code_data, headers=plugin.auth_headers())
+            resp = server_request('POST', '/api/v1/octo/g_code_files/', plugin, data=g_code_data, headers=plugin.auth_headers())
 
             return resp.json()['id'] if resp else None
 
@@ -43,6 +52,8 @@ class PrintJobTracker:
             with self._mutex:
                 self.current_print_ts = int(time.time())
                 self._file_metadata_cache = None
+                self.layer_index = self.load_layer_index(plugin, payload)
+                self.current_layer_z = None
 
             self.set_obico_g_code_file_id(find_obico_g_code_file_id(payload))
 
@@ -59,6 +70,8 @@ class PrintJobTracker:
                 self.set_obico_g_code_file_id(None)
                 self._file_metadata_cache = None
                 self.current_layer_height = None
+                self.current_layer_z = None
+                self.layer_index = None
 
                 # First layer AI
                 plugin.nozzlecam.on_first_layer = False # catch-all to make sure /nozzle_cam/first_layer_done/ is called in case such as canceled mid first layer.
@@ -66,42 +79,45 @@ class PrintJobTracker:
         return data
 
     def status(self, plugin, status_only=False):
+        status = plugin._printer.get_current_data()
+        temperatures = plugin._printer.get_current_temperatures()
         data = {
-            'status': plugin._printer.get_current_data()
+            'status': status
         }
 
         with self._mutex:
             data['current_print_ts'] = self.current_print_ts
-            current_file = data.get('status', {}).get('job', {}).get('file')
-            if self.get_obico_g_code_file_id() and current_file:
-                current_file['obico_g_code_file_id'] = self.get_obico_g_code_file_id()
+            current_file = status.get('job', {}).get('file')
+            obico_g_code_file_id = self.obico_g_code_file_id
+            if obico_g_code_file_id and current_file:
+                current_file['obico_g_code_file_id'] = obico_g_code_file_id
 
             # Injecting a 'G-Code Downloading' state so that the client side can treat it as a transition state
             if self.gcode_downloading_started is not None:
-                if data.get('status', {}).get('state', {}).get('text') != 'Operational': # It is in an unexpected state. Something has gone wrong
+                if status.get('state', {}).get('text') != 'Operational': # It is in an unexpected state. Something has gone wrong
                     self.set_gcode_downloading_started(None)
                 elif time.time() - self.gcode_downloading_started > MAX_GCODE_DOWNLOAD_SECONDS: # For the edge case that the download thread died without an exception
                     self.set_gcode_downloading_started(None)
                 else:
-                    data['status']['state']['text'] = 'G-Code Downloading'
-                    data['status']['state']['flags']['operational'] = False
-
-        # Apparently printers like Prusa throws random temperatures here. This should be consistent with OctoPrint, which only keeps r"^(tool\d+|bed|chamber)$"
-        temperatures = {}
-        for (k,v) in plugin._printer.get_current_temperatures().items():
-            if re.search(r'^(tool\d+|bed|chamber)$', k):
-                temperatures[k] = v
-
-        data['status']['temperatures'] = temperatures
-        data['status']['_ts'] = int(time.time())
-        data['status']['currentLayerHeight'] = self.current_layer_height # use camel-case to be consistent with the existing convention
-
-        if status_only:
-            if self._file_metadata_cache:
-                data['status']['file_metadata'] = self._file_metadata_cache
-            return data
-
-        data['status']['file_metadata'] = self._file_metadata_cache = self.get_file_metadata(plugin, data)
+                    status['state']['text'] = 'G-Code Downloading'
+                    status['state']['flags']['operational'] = False
+
+            status['temperatures'] = self.filter_temperatures(temperatures)
+            status['_ts'] = int(time.time())
+            status['currentLayerHeight'] = self.current_layer_height # use camel-case to be consistent with the existing convention
+            status['currentLayerZ'] = self.current_layer_z
+
+            if status_only:
+                if self._file_metadata_cache:
+                    status['file_metadata'] = self._file_metadata_cache
+                    status['file_metadata_version'] = self._file_metadata_version
+                return data
+
+        (metadata, version) = self.get_file_metadata(plugin, data)
+        status['file_metadata'] = self._file_metadata_cache = metadata
+        self._file_metadata_version = version
+        if version:
+            status['file_metadata_version'] = version
 
         octo_settings = plugin.octoprint_settings_updater.as_dict()
         if octo_settings:
@@ -109,9 +125,39 @@ class PrintJobTracker:
 
         return data
 
+    def filter_temperatures(self, temperatures):
+        # OctoPrint hands out a new dict every time, so it can be used as is if there's nothing to filter out, which is the usual case
+        with self._mutex:
+            if temperatures.keys() <= self._temperature_keys:
+                return temperatures
+
+            filtered = {}
+            for (k, v) in temperatures.items():
+                if k in self._temperature_keys or TEMPERATURE_KEY_RE.search(k):
+                    self._temperature_keys.add(k)
+                    filtered[k] = v
+            return filtered
+
+    def reset_temperature_keys(self):
+        # The printer has connected or disconnected. The next one may have other tools
+        with self._mutex:
+            self._temperature_keys = set()
+
     def increment_layer_height(self, val):
         with self._mutex:
             self.current_layer_height = val
+            layer = self.layer_index.layer(val) if self.layer_index else None
+            self.current_layer_z = layer['z'] if layer else None
+
+    def load_layer_index(self, plugin, payload):
+        # Sidecar written by GcodePreProcessor. Only for files uploaded since it's been there
+        if payload.get('origin') != 'local' or not payload.get('path'):
+            return None
+        try:
+            return LayerIndex.load(sidecar_path(plugin._file_manager.path_on_disk('local', payload['path'])))
+        except Exception:
+            _logger.exception('Failed to load layer index')
+            return None
 
     def set_obico_g_code_file_id(self, obico_g_code_file_id):
         with self._mutex:
@@ -126,14 +172,15 @@ class PrintJobTracker:
             self.gcode_downloading_started = timestamp
 
     def get_file_metadata(self, plugin, data):
+        # Return: (metadata, version)
         try:
             current_file = data.get('status', {}).get('job', {}).get('file', {})
             origin = current_file.get('origin')
             path = current_file.get('path')
             if not origin or not path:
-                return None
+                return (None, None)
 
-            return plugin._file_manager._storage_managers.get(origin).get_metadata(path) or {}
+            return file_metadata_cache.get(plugin._file_manager, origin, path)
         except Exception as e:
             _logger.exception(e)
-            return None
+            return (None, None)
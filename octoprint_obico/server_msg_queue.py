@@ -0,0 +1,248 @@
+# coding=utf-8
+import bson
+import json
+import logging
+import sys
+import threading
+import time
+from collections import deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .utils import TokenBucket
+
+__python_version__ = 3 if sys.version_info >= (3, 0) else 2
+
+_logger = logging.getLogger('octoprint.plugins.obico')
+
+# Messages to the server are put in one of 3 lanes:
+#   control: janus signaling, passthru acks, printer events and http tunnel responses. Always sent first.
+#   status:  printer status and print events. Plain status snapshots are coalesced so that only the newest is kept.
+#   bulk:    terminal feed and websocket tunnel traffic. Rate-shaped so that it can't hog the connection.
+CONTROL = 'control'
+STATUS = 'status'
+BULK = 'bulk'
+MSG_CLASSES = (CONTROL, STATUS, BULK)
+
+MAX_DEPTHS = {
+    CONTROL: 500,
+    STATUS: 100,
+    BULK: 1000,
+}
+
+BULK_MSGS_PER_SECOND = 200
+BULK_BURST = 400
+
+# Batch envelope (opt-in with the `batch_server_msgs` setting), sent as one binary frame:
+#
+#   bson({'batch': {'v': BATCH_ENVELOPE_VERSION, 'frames': [frame, frame, ...]}})
+#
+# Each frame is exactly what would have been sent as its own websocket frame without batching:
+# a str is a JSON text message and bytes is a BSON binary message. The server should process them in order.
+BATCH_ENVELOPE_VERSION = 1
+BATCH_WINDOW_SECONDS = 0.02
+BATCH_MAX_MSGS = 100
+BATCH_MAX_BYTES = 512 * 1024
+
+
+def classify_server_msg(data):
+    # Return: (msg_class, coalesce_key). Messages with the same coalesce_key replace each other while queued.
+    if 'janus' in data or 'http.tunnel' in data or 'http.tunnelv2' in data:
+        return CONTROL, None
+
+    passthru = data.get('passthru')
+    if passthru is not None:
+        if 'terminal_feed' in passthru:
+            return BULK, None
+        return CONTROL, None
+
+    if 'ws.tunnel' in data:
+        return BULK, None
+
+    if 'status' in data and 'event' not in data:
+        return STATUS, 'status'
+
+    return STATUS, None
+
+
+def serialize_server_msg(data, as_binary):
+    if as_binary:
+        raw = bson.dumps(data)
+        _logger.debug("Sending binary (%d bytes) to server", len(raw))
+    else:
+        _logger.debug("Sending to server: \n%s", data)
+        if __python_version__ == 3:
+            raw = json.dumps(data, default=str)
+        else:
+            raw = json.dumps(data, encoding='iso-8859-1', default=str)
+    return raw
+
+
+def serialize_server_msgs(msgs):
+    # Return: (raw, as_binary) of the websocket frame to send for a list of (data, as_binary)
+    if len(msgs) == 1:
+        (data, as_binary) = msgs[0]
+        return (serialize_server_msg(data, as_binary), as_binary)
+
+    frames = [serialize_server_msg(data, as_binary) for (data, as_binary) in msgs]
+    return (bson.dumps({'batch': {'v': BATCH_ENVELOPE_VERSION, 'frames': frames}}), True)
+
+
+class _Lane:
+
+    def __init__(self, max_depth):
+        self.max_depth = max_depth
+        self.entries = deque()
+        self.by_key = dict()
+        self.depth = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.dequeued = 0
+
+
+class ServerMessageQueue:
+
+    def __init__(self, bulk_rate=BULK_MSGS_PER_SECOND, bulk_burst=BULK_BURST):
+        self._mutex = threading.RLock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._lanes = {msg_class: _Lane(MAX_DEPTHS[msg_class]) for msg_class in MSG_CLASSES}
+        self._bulk_bucket = TokenBucket(bulk_rate, bulk_burst)
+
+    def put(self, data, as_binary=False, msg_class=None, coalesce_key=None, block=False, timeout=None, on_dequeue=None):
+        # Return: True if the message is queued. False if it is dropped because its lane is full.
+        # block: wait (up to `timeout` seconds) for room in the lane instead of dropping. For producers that can't afford losing messages, such as streamed responses.
+        # on_dequeue: called without arguments once the message is taken off the queue to be sent.
+        if msg_class is None:
+            (msg_class, coalesce_key) = classify_server_msg(data)
+
+        deadline = time.time() + timeout if timeout is not None else None
+
+        with self._mutex:
+            lane = self._lanes[msg_class]
+            old_entry = lane.by_key.get(coalesce_key) if coalesce_key is not None else None
+
+            if old_entry is None and block:
+                while lane.depth >= lane.max_depth:
+                    remaining = deadline - time.time() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._not_full.wait(remaining)
+
+            if old_entry is not None:
+                # Drop the stale one and put the newest at the back so that it won't jump ahead of messages queued in-between
+                old_entry[2] = False
+                lane.depth -= 1
+                lane.coalesced += 1
+            elif lane.depth >= lane.max_depth:
+                lane.dropped += 1
+                return False
+
+            entry = [data, as_binary, True, coalesce_key, on_dequeue]
+            lane.entries.append(entry)
+            lane.depth += 1
+            if coalesce_key is not None:
+                lane.by_key[coalesce_key] = entry
+
+            self._not_empty.notify()
+
+        if old_entry is not None and old_entry[4] is not None:    # The replaced message has left the queue too
+            old_entry[4]()
+        return True
+
+    def get(self, block=True, timeout=None):
+        # Return: (data, as_binary). Raises queue.Empty like queue.Queue.get
+        deadline = time.time() + timeout if timeout is not None else None
+
+        with self._not_empty:
+            while True:
+                (entry, bulk_wait) = self._pop_next()
+                if entry is not None:
+                    break
+
+                if not block:
+                    raise queue.Empty
+
+                wait = bulk_wait
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    wait = min(wait, remaining) if wait is not None else remaining
+
+                self._not_empty.wait(wait)
+
+        if entry[4] is not None:
+            entry[4]()
+        return (entry[0], entry[1])
+
+    def get_batch(self, window=BATCH_WINDOW_SECONDS, max_msgs=BATCH_MAX_MSGS, max_bytes=BATCH_MAX_BYTES):
+        # Block for the first message, then keep draining for up to `window` seconds.
+        # Return: list of (data, as_binary)
+        msgs = [self.get()]
+        deadline = time.time() + window
+        approx_bytes = _approx_size(msgs[0][0])
+        while len(msgs) < max_msgs and approx_bytes < max_bytes:
+            remaining = deadline - time.time()
+            try:
+                msg = self.get(block=remaining > 0, timeout=remaining if remaining > 0 else None)
+            except queue.Empty:
+                break
+            msgs.append(msg)
+            approx_bytes += _approx_size(msg[0])
+
+        return msgs
+
+    def qsize(self):
+        with self._mutex:
+            return sum(lane.depth for lane in self._lanes.values())
+
+    def as_dict(self):
+        with self._mutex:
+            return {
+                msg_class: dict(depth=lane.depth, dropped=lane.dropped, coalesced=lane.coalesced, dequeued=lane.dequeued)
+                for (msg_class, lane) in self._lanes.items()
+            }
+
+    def _pop_next(self):
+        # Return: (entry, bulk_wait). bulk_wait is how long to wait for the bulk lane to be allowed to send again, if it is the only lane that is not empty.
+        for msg_class in (CONTROL, STATUS):
+            entry = self._pop_lane(self._lanes[msg_class])
+            if entry is not None:
+                return (entry, None)
+
+        bulk_lane = self._lanes[BULK]
+        if bulk_lane.depth == 0:
+            return (None, None)
+
+        if not self._bulk_bucket.try_consume():
+            return (None, self._bulk_bucket.wait_time())
+
+        return (self._pop_lane(bulk_lane), None)
+
+    def _pop_lane(self, lane):
+        while lane.entries:
+            entry = lane.entries.popleft()
+            if not entry[2]:    # Coalesced away by a newer message
+                continue
+
+            lane.depth -= 1
+            lane.dequeued += 1
+            if entry[3] is not None and lane.by_key.get(entry[3]) is entry:
+                del lane.by_key[entry[3]]
+            self._not_full.notify_all()
+            return entry
+
+        return None
+
+
+def _approx_size(data):
+    # Good enough to keep batches bounded without serializing twice. Big payloads are tunnel responses, whole or streamed in chunks.
+    for key in ('http.tunnel', 'http.tunnelv2', 'ws.tunnel'):
+        if key in data:
+            payload = data[key].get('response') or data[key].get('chunk') or data[key]
+            content = payload.get('content') or payload.get('data')
+            return len(content) if content is not None and hasattr(content, '__len__') else 0
+    return 0
@@ -0,0 +1,78 @@
+# coding=utf-8
+import threading
+
+# Delta encoding of printer status (opt-in with the `status_delta_encoding` setting).
+#
+# Keyframe, sent every `keyframe_interval` updates, after a reset, and with every print event:
+#   {'status': {...full status...}, 'status_seq': 42}
+#
+# Delta, relative to the status with seq `base`:
+#   {'status_delta': {'seq': 43, 'base': 42, 'set': {...}, 'unset': [['path', 'to', 'key'], ...]}}
+#
+# `set` is a nested dict with only the changed leaves. Lists are treated as leaves.
+# A receiver that doesn't have `base` (e.g. a lost UDP packet) should ignore deltas until the next keyframe.
+
+DEFAULT_KEYFRAME_INTERVAL = 30
+
+
+class StatusDeltaEncoder:
+
+    def __init__(self, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+        self._mutex = threading.RLock()
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self.last_sent = None
+        self.deltas_since_keyframe = 0
+
+    def reset(self):
+        # Make sure the next update is a keyframe, e.g. when the receiver may have lost track
+        with self._mutex:
+            self.last_sent = None
+
+    def encode(self, status, force_keyframe=False):
+        with self._mutex:
+            self.seq += 1
+
+            if force_keyframe or self.last_sent is None or self.deltas_since_keyframe >= self.keyframe_interval:
+                self.last_sent = _snapshot(status)
+                self.deltas_since_keyframe = 0
+                return {'status': status, 'status_seq': self.seq}
+
+            (changed, removed) = _diff(self.last_sent, status, ())
+            self.last_sent = _snapshot(status)
+            self.deltas_since_keyframe += 1
+            return {'status_delta': {'seq': self.seq, 'base': self.seq - 1, 'set': changed, 'unset': removed}}
+
+
+def _snapshot(value):
+    # OctoPrint may hand out references to its own dicts, so keep a copy of what was sent rather than the objects themselves
+    if isinstance(value, dict):
+        return {k: _snapshot(v) for (k, v) in value.items()}
+    if isinstance(value, list):
+        return [_snapshot(v) for v in value]
+    return value
+
+
+def _diff(old, new, path):
+    changed = {}
+    removed = []
+
+    for (k, v) in new.items():
+        if k not in old:
+            changed[k] = v
+            continue
+
+        old_v = old[k]
+        if isinstance(v, dict) and isinstance(old_v, dict):
+            (sub_changed, sub_removed) = _diff(old_v, v, path + (k,))
+            if sub_changed:
+                changed[k] = sub_changed
+            removed.extend(sub_removed)
+        elif old_v != v or type(old_v) is not type(v):
+            changed[k] = v
+
+    for k in old:
+        if k not in new:
+            removed.append(list(path + (k,)))
+
+    return (changed, removed)
@@ -0,0 +1,68 @@
+# coding=utf-8
+import copy
+import threading
+import time
+
+import octoprint.printer
+
+
+# Printer status is pushed when OctoPrint says something has changed, rather than polled.
+#   on_change:       called for every status or temperature update. For the client, which wants everything as it happens.
+#   on_state_change: called only when the printer state or the selected file changes. For the server, which doesn't.
+class StatusPushCallback(octoprint.printer.PrinterCallback):
+
+    def __init__(self, on_change, on_state_change):
+        self.on_change = on_change
+        self.on_state_change = on_state_change
+        self.last_state = None
+
+    def on_printer_send_initial_data(self, data):
+        self.on_printer_send_current_data(data)
+
+    def on_printer_send_current_data(self, data):
+        self.on_change()
+
+        state = (data.get('state'), ((data.get('job') or {}).get('file') or {}).get('path'))
+        if state != self.last_state:
+            self.last_state = state
+            self.on_state_change()
+
+    def on_printer_add_temperature(self, data):
+        self.on_change()
+
+
+# OctoPrint calls back with temperatures every couple of seconds even when nothing has changed. Lets a status through only if it's
+# different from the last one that was (`_ts` aside), it's been `heartbeat` seconds since, or force() has been called, e.g. a viewer joined.
+class StatusChangeFilter:
+
+    def __init__(self, heartbeat):
+        self._mutex = threading.RLock()
+        self.heartbeat = heartbeat
+        self.last_passed = None
+        self.last_passed_ts = 0
+        self.forced = False
+
+        self.passed = 0
+        self.unchanged = 0
+
+    def force(self):
+        with self._mutex:
+            self.forced = True
+
+    def should_send(self, status):
+        comparable = {k: v for (k, v) in status.items() if k != '_ts'}
+        with self._mutex:
+            now = time.time()
+            if not self.forced and comparable == self.last_passed and now < self.last_passed_ts + self.heartbeat:
+                self.unchanged += 1
+                return False
+
+            self.forced = False
+            self.last_passed = copy.deepcopy(comparable)   # OctoPrint may change its dicts in place
+            self.last_passed_ts = now
+            self.passed += 1
+            return True
+
+    def as_dict(self):
+        with self._mutex:
+            return dict(passed=self.passed, unchanged=self.unchanged)
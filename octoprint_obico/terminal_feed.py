@@ -0,0 +1,140 @@
+# coding=utf-8
+import logging
+import threading
+import time
+from collections import deque
+
+from .utils import TokenBucket
+
+_logger = logging.getLogger('octoprint.plugins.obico')
+
+# By default, each terminal feed line is queued to the server as a message of its own, as soon as it comes in (as it has always been).
+#
+# Batched (opt-in with the `terminal_feed_batching` setting), lines are buffered and flushed to the server every `flush_interval`
+# seconds, or as soon as `max_lines` have piled up:
+#
+#   {'passthru': {'terminal_feed': {'msgs': [{'msg': ..., '_ts': ...}, ...], 'suppressed': N, '_ts': ...}}}
+#
+# Lines over `max_rate` (lines per second, 0 for no limit) or beyond what the ring buffer holds are then dropped, and a
+# "N lines suppressed" line is sent in their place, so the viewer knows the feed has gaps. A batch that takes more than one message
+# has N in the last one, along with that line, and 0 in the others.
+DEFAULT_FLUSH_INTERVAL = 0.1
+DEFAULT_MAX_LINES = 50
+DEFAULT_MAX_RATE = 100
+BUFFER_SIZE = 1000
+
+SUPPRESSED_MSG = '[Obico] {} lines suppressed'
+
+
+class TerminalFeed:
+
+    def __init__(self, send):
+        # send(data): queues a message to the server
+        self._mutex = threading.RLock()
+        self._flush_due = threading.Condition(self._mutex)
+        self.send = send
+        self.batched = False
+        self.flush_interval = DEFAULT_FLUSH_INTERVAL
+        self.max_lines = DEFAULT_MAX_LINES
+        self.rate_limit = None
+        self.lines = deque(maxlen=BUFFER_SIZE)
+        self.suppressed = 0
+        self.flush_thread = None
+
+        self.lines_in = 0
+        self.lines_out = 0
+        self.lines_suppressed = 0
+        self.msgs_out = 0
+        self.configure()
+
+    def configure(self, batched=False, flush_interval=DEFAULT_FLUSH_INTERVAL, max_lines=DEFAULT_MAX_LINES, max_rate=DEFAULT_MAX_RATE):
+        with self._mutex:
+            self.batched = batched
+            self.flush_interval = flush_interval
+            self.max_lines = max(1, max_lines)
+            self.rate_limit = TokenBucket(max_rate, max_rate) if batched and max_rate else None
+
+    def add(self, msg):
+        with self._mutex:
+            self.lines_in += 1
+            if self.batched:
+                self.buffer(msg)
+                return
+            self.lines_out += 1
+            self.msgs_out += 1
+        self.send({'passthru': {'terminal_feed': {'msg': msg, '_ts': time.time()}}})
+
+    def buffer(self, msg):
+        with self._mutex:
+            if self.rate_limit and not self.rate_limit.try_consume():
+                self.suppressed += 1
+                if self.suppressed == 1:
+                    self._flush_due.notify()
+                return
+
+            if len(self.lines) == self.lines.maxlen:    # The oldest line is pushed out
+                self.suppressed += 1
+            self.lines.append({'msg': msg, '_ts': time.time()})
+
+            if self.flush_thread is None:
+                self.flush_thread = threading.Thread(target=self.flush_loop)
+                self.flush_thread.daemon = True
+                self.flush_thread.start()
+            if len(self.lines) == 1 or len(self.lines) >= self.max_lines:
+                self._flush_due.notify()
+
+    def clear(self):
+        with self._mutex:
+            self.lines.clear()
+            self.suppressed = 0
+
+    def flush_loop(self):
+        while True:
+            with self._mutex:
+                while not self.lines and not self.suppressed:
+                    self._flush_due.wait()
+                if len(self.lines) < self.max_lines:
+                    self._flush_due.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                _logger.exception('Failed to flush terminal feed')
+
+    def flush(self):
+        with self._mutex:
+            if not self.lines and not self.suppressed:
+                return
+            lines = list(self.lines)
+            self.lines.clear()
+            suppressed = self.suppressed
+            self.suppressed = 0
+            self.lines_out += len(lines)
+            self.lines_suppressed += suppressed
+            (batched, max_lines) = (self.batched, self.max_lines)
+
+        if suppressed:
+            lines.append({'msg': SUPPRESSED_MSG.format(suppressed), '_ts': time.time()})
+
+        if batched:
+            starts = range(0, len(lines), max_lines)
+            msgs = [
+                {'passthru': {'terminal_feed': {'msgs': lines[i:i + max_lines], 'suppressed': suppressed if i == starts[-1] else 0, '_ts': time.time()}}}
+                for i in starts]
+        else:
+            msgs = [{'passthru': {'terminal_feed': line}} for line in lines]
+
+        for msg in msgs:
+            self.send(msg)
+        with self._mutex:
+            self.msgs_out += len(msgs)
+
+    def as_dict(self):
+        with self._mutex:
+            return dict(
+                batched=self.batched,
+                buffered=len(self.lines),
+                lines_in=self.lines_in,
+                lines_out=self.lines_out,
+                lines_suppressed=self.lines_suppressed + self.suppressed,
+                msgs_out=self.msgs_out,
+            )
@@ -5,31 +5,78 @@ import threading
 import time
 import os
 import sys
-import zlib
+from collections import deque
 try:
     from urllib.parse import urljoin
 except ImportError:
     from urlparse import urljoin
+try:
+    from http.cookiejar import DefaultCookiePolicy
+except ImportError:
+    from cookielib import DefaultCookiePolicy
 
-from .ws import WebSocketClient
+from .ws import create_ws_client
+from .lib.worker_pool import WorkerPool
+from .lib.compression_policy import CompressionPolicy, compressobj, thread_time
+from .lib.response_cache import TunnelResponseCache, DEFAULT_MAX_BYTES as DEFAULT_CACHE_BYTES
+from .utils import run_in_thread
+from .server_msg_queue import BULK
+from .tunnel_relay import TunnelRelay, DEFAULT_CREDIT_WINDOW
 
 WRITE_MODE = 'w' if sys.version_info[0] < 3 else 'wb'
 READ_MODE = 'r' if sys.version_info[0] < 3 else 'rb'
-COMPRESS_THRESHOLD = 1000
+DEFAULT_HTTP_WORKERS = 4
+DEFAULT_HTTP_BACKLOG = 64
+
+# Bodies are compressed as CompressionPolicy sees fit. A response with 'compressed': True has 'codec' set too, unless it's zlib.
+
+# Streamed responses (opt-in with the `tunnel_streaming` setting) for bodies that are big or of unknown length.
+# Instead of one message with the whole body, the server gets:
+#
+#   head:   {'http.tunnel': {'ref': ref, 'response': {'status': ..., 'headers': {...}, 'compressed': ..., 'stream': True}}}
+#   chunks: {'http.tunnel': {'ref': ref, 'chunk': {'seq': 0, 'content': b'...'}}}, seq 1, 2, ...
+#   end:    {'http.tunnel': {'ref': ref, 'chunk': {'seq': n, 'content': b'...', 'end': True}}}, plus 'error' if the body couldn't be read to the end
+#
+# The contents of all chunks concatenated are the body, or one compressed stream if 'compressed' is True. Same for 'http.tunnelv2', whose head also has 'cookies'.
+STREAM_THRESHOLD = 1024 * 1024
+STREAM_READ_SIZE = 64 * 1024
+STREAM_MAX_INFLIGHT_CHUNKS = 8    # Chunks queued to the server but not yet sent. Bounds memory use per stream
+STREAM_SEND_TIMEOUT = 30
+
+WS_CONNECT_TIMEOUT = 30
+WS_MAX_PENDING_FRAMES = 200     # Frames from the server buffered while the OctoPrint websocket is still connecting
 
 _logger = logging.getLogger('octoprint.plugins.obico')
 
 
 class LocalTunnel(object):
 
-    def __init__(self, base_url, on_http_response, on_ws_message, data_dir, sentry):
+    def __init__(self, base_url, on_http_response, on_ws_message, data_dir, sentry,
+                 http_workers=DEFAULT_HTTP_WORKERS, http_backlog=DEFAULT_HTTP_BACKLOG, stream_responses=False,
+                 compression_codec=None, compression_level=None, cache_bytes=DEFAULT_CACHE_BYTES,
+                 ws_credit_window=DEFAULT_CREDIT_WINDOW):
         self.base_url = base_url
         self.on_http_response = on_http_response
         self.on_ws_message = on_ws_message
         self.sentry = sentry
+        self._mutex = threading.RLock()
         self.ref_to_ws = {}
+        self.ws_stats = TunnelWebSocketStats()
+        self.ws_credit_window = ws_credit_window
+        self.http_pool = WorkerPool('obico-tunnel', http_workers, http_backlog)
+        self.stream_responses = stream_responses
+        self.compression = CompressionPolicy(codec=compression_codec or 'zlib', level=compression_level)
+        self.response_cache = TunnelResponseCache(max_bytes=cache_bytes)
         self.cj_path = os.path.join(data_dir, '.tunnel.cj.pickled')
         self.request_session = requests.Session()
+
+        # v2 passes cookies through between the browser and OctoPrint, so its session only pools connections and never keeps a cookie
+        self.v2_session = requests.Session()
+        self.v2_session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        v2_adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=http_workers)
+        self.v2_session.mount('http://', v2_adapter)
+        self.v2_session.mount('https://', v2_adapter)
+
         try:
             with open(self.cj_path, READ_MODE) as fp:
                 jar = pickle.load(fp)
@@ -38,6 +85,120 @@ class LocalTunnel(object):
         except:
             pass   # Start with a clean session without cookies if cookie jar loading fails for any reason
 
+    def submit_http_to_local(self, kwargs):
+        if not self.http_pool.submit(self.send_http_to_local, **kwargs):
+            self.reject_http_to_local('http.tunnel', kwargs)
+
+    def submit_http_to_local_v2(self, kwargs):
+        if not self.http_pool.submit(self.send_http_to_local_v2, **kwargs):
+            self.reject_http_to_local('http.tunnelv2', kwargs)
+
+    def reject_http_to_local(self, msg_type, kwargs):
+        _logger.warning('Tunnel backlog is full. Rejecting "{}"'.format(kwargs.get('path')))
+        resp_data = {
+            'status': 503,
+            'content': 'Too many tunnel requests in progress',
+            'headers': {'Retry-After': '1'}
+        }
+        self.on_http_response(
+            {msg_type: {'ref': kwargs.get('ref'), 'response': resp_data}},
+            as_binary=True)
+
+    def as_dict(self):
+        return dict(
+            http_pool=self.http_pool.as_dict(),
+            ws=self.ws_stats.as_dict(len(self.ref_to_ws)),
+            ws_relays=self.ws_relays_as_dict(),
+            compression=self.compression.as_dict(),
+            response_cache=self.response_cache.as_dict())
+
+    def ws_relays_as_dict(self):
+        with self._mutex:
+            return {ref: ws.relay.as_dict() for (ref, ws) in self.ref_to_ws.items()}
+
+    def conditional_headers(self, cache_entry, headers):
+        # Revalidate a stale cache entry rather than fetching it again. The requester's own validators are then answered from the cache
+        if cache_entry is None:
+            return headers
+        headers = {k: v for (k, v) in headers.items() if k.lower() not in ('if-none-match', 'if-modified-since')}
+        headers.update(cache_entry.validators())
+        return headers
+
+    def compressed_content(self, resp):
+        # Return: the 'compressed', 'content' and, if not zlib, 'codec' fields of a response
+        (content, codec) = self.compression.compress(resp.content, resp.headers.get('Content-Type'), resp.headers.get('Content-Encoding'))
+        fields = {'compressed': codec is not None, 'content': content}
+        if codec not in (None, 'zlib'):
+            fields['codec'] = codec
+        return fields
+
+    def should_stream(self, resp):
+        if not self.stream_responses:
+            return False
+        try:
+            return int(resp.headers.get('Content-Length')) > STREAM_THRESHOLD
+        except (TypeError, ValueError):
+            return True     # Chunked, or unknown length
+
+    def stream_http_response(self, msg_type, ref, resp, head):
+        # Never raises once the head is sent, as the server can't take a regular response for the same ref any more.
+        inflight = threading.Semaphore(STREAM_MAX_INFLIGHT_CHUNKS)
+
+        def send(msg, msg_class=None):
+            if not inflight.acquire(timeout=STREAM_SEND_TIMEOUT):
+                return False
+            return self.on_http_response(
+                msg, as_binary=True, msg_class=msg_class,
+                block=True, timeout=STREAM_SEND_TIMEOUT, on_dequeue=inflight.release)
+
+        def send_chunk(chunk):
+            # Chunks compete with the other bulk traffic so that a big download can't starve printer status and control messages
+            return send({msg_type: {'ref': ref, 'chunk': chunk}}, msg_class=BULK)
+
+        content_type = resp.headers.get('Content-Type')
+        compressor = None
+        if self.compression.should_compress(content_type, resp.headers.get('Content-Encoding')):
+            compressor = compressobj(self.compression.codec, self.compression.level)
+            if self.compression.codec != 'zlib':
+                head['codec'] = self.compression.codec
+        head['compressed'] = compressor is not None
+        head['stream'] = True
+
+        seq = 0
+        bytes_in = 0
+        bytes_out = 0
+        cpu_seconds = 0.0
+        try:
+            if not send({msg_type: {'ref': ref, 'response': head}}):
+                _logger.warning('Failed to send head of streamed response. Aborting')
+                return
+
+            for data in resp.iter_content(chunk_size=STREAM_READ_SIZE):
+                bytes_in += len(data)
+                if compressor:
+                    start = thread_time()
+                    content = compressor.compress(data)
+                    cpu_seconds += thread_time() - start
+                else:
+                    content = data
+                if not content:
+                    continue
+                bytes_out += len(content)
+                if not send_chunk({'seq': seq, 'content': content}):
+                    _logger.warning('Timed out sending streamed response. Aborting')
+                    return
+                seq += 1
+
+            content = compressor.flush() if compressor else b''
+            bytes_out += len(content)
+            send_chunk({'seq': seq, 'content': content, 'end': True})
+        except Exception as ex:
+            _logger.warning('Error while streaming response: {}'.format(ex))
+            send_chunk({'seq': seq, 'content': b'', 'end': True, 'error': repr(ex)})
+        finally:
+            resp.close()
+            self.compression.record(content_type, bytes_in, bytes_out, cpu_seconds, compressed=compressor is not None)
+
     def send_http_to_local(
             self, ref, method, path,
             params=None, data=None, headers=None, timeout=30):
@@ -45,37 +206,63 @@ class LocalTunnel(object):
         url = urljoin(self.base_url, path)
 
         _logger.debug('Tunneling "{}"'.format(url))
+        resp = None
         try:
+            cache_key = self.response_cache.cache_key('v1', method, path, params, headers)
+            cache_entry = self.response_cache.lookup(cache_key, headers)
+            if cache_entry is not None and cache_entry.is_fresh():
+                self.on_http_response(
+                    {'http.tunnel': {'ref': ref, 'response': cache_entry.response_fields(headers)}},
+                    as_binary=True)
+                return
+
             resp = getattr(self.request_session, method)(
                 url,
                 params=params,
-                headers={k: v for k, v in headers.items() if k != 'Cookie'},
+                headers=self.conditional_headers(cache_entry, {k: v for k, v in headers.items() if k != 'Cookie'}),
                 data=data,
                 timeout=timeout,
-                allow_redirects=False)
+                allow_redirects=False,
+                stream=self.stream_responses)
 
             save_cookies = False
             if resp.status_code == 403:      # failed to authenticate
                 self.request_session.cookies.clear()
                 save_cookies = True
 
-            if resp.headers.pop('Set-Cookie', None) or save_cookies: # Stop set-cookie from being propagated to Obico Server
+            set_cookie = resp.headers.pop('Set-Cookie', None)
+            if set_cookie or save_cookies: # Stop set-cookie from being propagated to Obico Server
                 with open(self.cj_path, WRITE_MODE) as fp:
                     pickle.dump(self.request_session.cookies, fp)
 
-            compress = len(resp.content) >= COMPRESS_THRESHOLD
-            resp_data = {
-                'status': resp.status_code,
-                'compressed': compress,
-                'content': zlib.compress(resp.content) if compress else resp.content,
-                'headers': {k: v for k, v in resp.headers.items()},
-            }
+            if cache_entry is not None and resp.status_code == 304:
+                resp.close()
+                self.response_cache.refresh(cache_entry, resp.headers)
+                resp_data = cache_entry.response_fields(headers)
+            elif self.should_stream(resp):
+                self.stream_http_response('http.tunnel', ref, resp, {
+                    'status': resp.status_code,
+                    'headers': {k: v for k, v in resp.headers.items()},
+                })
+                return
+            else:
+                resp_data = {
+                    'status': resp.status_code,
+                    'headers': {k: v for k, v in resp.headers.items()},
+                }
+                content_fields = self.compressed_content(resp)
+                resp_data.update(content_fields)
+                if not set_cookie:
+                    self.response_cache.store(cache_key, headers, resp.status_code, resp_data['headers'], content_fields)
         except Exception as ex:
             resp_data = {
                 'status': 502,
                 'content': repr(ex),
                 'headers': {}
             }
+        finally:
+            if resp is not None:    # Streamed responses hold on to their connection until closed
+                resp.close()
 
         self.on_http_response(
             {'http.tunnel': {'ref': ref, 'response': resp_data}},
@@ -83,52 +270,86 @@ class LocalTunnel(object):
         return
 
     def send_ws_to_local(self, ref, path, data, type_):
-        ws = self.ref_to_ws.get(ref, None)
+        # Called on the server message thread. Must not block on connecting to OctoPrint
+        with self._mutex:
+            ws = self.ref_to_ws.get(ref, None)
 
-        if type_ == 'tunnel_close':
-            if ws is not None:
-                ws.close()
-            return
+            if type_ == 'tunnel_close':
+                if ws is not None:
+                    self.remove_octoprint_ws(ref, ws)
+                    ws.close()
+                return
 
-        if ws is None:
-            self.connect_octoprint_ws(ref, path)
-            time.sleep(1)  # Wait to make sure websocket is established before `send` is called
+            if ws is None:
+                ws = self.connect_octoprint_ws(ref, path)
 
         if data is not None:
             ws.send(data)
 
     def connect_octoprint_ws(self, ref, path):
+        # Return: a TunnelWebSocket that buffers what's sent to it until the connection is open
         def on_ws_close(ws, **kwargs):
             _logger.info("OctoPrint WS is closing")
-            if ref in self.ref_to_ws:
-                del self.ref_to_ws[ref]     # Remove octoprint ws from refs as on_ws_message may fail
+            relay.close()
+            if self.remove_octoprint_ws(ref, tunnel_ws):
                 self.on_ws_message(
                     {'ws.tunnel': {'ref': ref, 'data': None, 'type': 'octoprint_close'}},
                     as_binary=True)
 
+        def relay_to_server(data, on_dequeue):
+            return self.on_ws_message(
+                {'ws.tunnel': {'ref': ref, 'data': data, 'type': 'octoprint_message'}},
+                as_binary=True, on_dequeue=on_dequeue)
+
         def on_ws_msg(ws, data):
             try:
-                self.on_ws_message(
-                    {'ws.tunnel': {'ref': ref, 'data': data, 'type': 'octoprint_message'}},
-                    as_binary=True)
+                tunnel_ws.on_first_frame()
+                relay.relay(data)
             except:
                 self.sentry.captureException()
                 ws.close()
 
+        def connect():
+            try:
+                ws = create_ws_client(
+                    url,
+                    token=None,
+                    on_ws_msg=on_ws_msg,
+                    on_ws_close=on_ws_close,
+                    waitsecs=WS_CONNECT_TIMEOUT,
+                    blocking_callbacks=True,    # The relay holds back on_ws_msg when the server falls behind
+                )
+            except Exception as e:
+                _logger.warning('Failed to connect to OctoPrint WS: {}'.format(e))
+                self.ws_stats.record_connect_failure()
+                on_ws_close(None)
+                return
+
+            tunnel_ws.on_connected(ws)
+
         url = urljoin(self.base_url, path)
         url = url.replace('http://', 'ws://')
         url = url.replace('https://', 'wss://')
 
-        ws = WebSocketClient(
-            url,
-            token=None,
-            on_ws_msg=on_ws_msg,
-            on_ws_close=on_ws_close,
-        )
-        self.ref_to_ws[ref] = ws
+        relay = TunnelRelay(relay_to_server, credit_window=self.ws_credit_window)
+        tunnel_ws = TunnelWebSocket(self.ws_stats, relay)
+        with self._mutex:
+            self.ref_to_ws[ref] = tunnel_ws
+        run_in_thread(connect)
+        return tunnel_ws
+
+    def remove_octoprint_ws(self, ref, tunnel_ws):
+        # Return: True if it was still registered for ref
+        with self._mutex:
+            if self.ref_to_ws.get(ref) is tunnel_ws:
+                del self.ref_to_ws[ref]     # Remove octoprint ws from refs as on_ws_message may fail
+                return True
+            return False
 
     def close_all_octoprint_ws(self):
-        for ref, ws in self.ref_to_ws.items():
+        with self._mutex:
+            all_ws = list(self.ref_to_ws.values())
+        for ws in all_ws:
             ws.close()
 
     def send_http_to_local_v2(
@@ -138,14 +359,26 @@ class LocalTunnel(object):
         url = urljoin(self.base_url, path)
 
         _logger.debug('Tunneling (v2) "{}"'.format(url))
+        resp = None
         try:
-            resp = getattr(requests, method)(
+            cache_key = self.response_cache.cache_key('v2', method, path, params, headers)
+            cache_entry = self.response_cache.lookup(cache_key, headers)
+            if cache_entry is not None and cache_entry.is_fresh():
+                resp_data = cache_entry.response_fields(headers)
+                resp_data['cookies'] = None
+                self.on_http_response(
+                    {'http.tunnelv2': {'ref': ref, 'response': resp_data}},
+                    as_binary=True)
+                return
+
+            resp = getattr(self.v2_session, method)(
                 url,
                 params=params,
-                headers={k: v for k, v in headers.items()},
+                headers=self.conditional_headers(cache_entry, {k: v for k, v in headers.items()}),
                 data=data,
                 timeout=timeout,
-                allow_redirects=False) # The redirect should happen in the browser, not the plugin. Otherwise it causes tricky problems.
+                allow_redirects=False, # The redirect should happen in the browser, not the plugin. Otherwise it causes tricky problems.
+                stream=self.stream_responses)
 
             if sys.version_info[0] < 3:
                 cookies = [
@@ -156,26 +389,139 @@ class LocalTunnel(object):
             else:
                 cookies = resp.raw._original_response.msg.get_all('Set-Cookie')
 
-            compress = len(resp.content) >= COMPRESS_THRESHOLD
-            resp_data = {
-                'status': resp.status_code,
-                'compressed': compress,
-                'content': (
-                    zlib.compress(resp.content)
-                    if compress
-                    else resp.content
-                ),
-                'cookies': cookies,
-                'headers': {k: v for k, v in resp.headers.items()},
-            }
+            if cache_entry is not None and resp.status_code == 304:
+                resp.close()
+                self.response_cache.refresh(cache_entry, resp.headers)
+                resp_data = cache_entry.response_fields(headers)
+                resp_data['cookies'] = cookies
+            elif self.should_stream(resp):
+                self.stream_http_response('http.tunnelv2', ref, resp, {
+                    'status': resp.status_code,
+                    'cookies': cookies,
+                    'headers': {k: v for k, v in resp.headers.items()},
+                })
+                return
+            else:
+                resp_data = {
+                    'status': resp.status_code,
+                    'cookies': cookies,
+                    'headers': {k: v for k, v in resp.headers.items()},
+                }
+                content_fields = self.compressed_content(resp)
+                resp_data.update(content_fields)
+                if not cookies:
+                    # Responses that set cookies are specific to the requester
+                    self.response_cache.store(cache_key, headers, resp.status_code, resp_data['headers'], content_fields)
         except Exception as ex:
             resp_data = {
                 'status': 502,
                 'content': repr(ex),
                 'headers': {}
             }
+        finally:
+            if resp is not None:    # Streamed responses hold on to their connection until closed
+                resp.close()
 
         self.on_http_response(
             {'http.tunnelv2': {'ref': ref, 'response': resp_data}},
             as_binary=True)
         return
+
+
+class TunnelWebSocketStats:
+
+    def __init__(self):
+        self._mutex = threading.RLock()
+        self.connects = 0
+        self.connect_failures = 0
+        self.pending_dropped = 0
+        self.first_frames = 0
+        self.time_to_first_frame_total = 0.0
+        self.time_to_first_frame_max = 0.0
+        self.last_time_to_first_frame = None
+
+    def record_connect_failure(self):
+        with self._mutex:
+            self.connect_failures += 1
+
+    def record_connected(self):
+        with self._mutex:
+            self.connects += 1
+
+    def record_pending_dropped(self):
+        with self._mutex:
+            self.pending_dropped += 1
+
+    def record_first_frame(self, seconds):
+        with self._mutex:
+            self.first_frames += 1
+            self.time_to_first_frame_total += seconds
+            self.time_to_first_frame_max = max(self.time_to_first_frame_max, seconds)
+            self.last_time_to_first_frame = seconds
+
+    def as_dict(self, open_connections):
+        with self._mutex:
+            return dict(
+                connections=open_connections,
+                connects=self.connects,
+                connect_failures=self.connect_failures,
+                pending_dropped=self.pending_dropped,
+                avg_time_to_first_frame_seconds=self.time_to_first_frame_total / self.first_frames if self.first_frames else None,
+                max_time_to_first_frame_seconds=self.time_to_first_frame_max,
+                last_time_to_first_frame_seconds=self.last_time_to_first_frame,
+            )
+
+
+class TunnelWebSocket:
+    # Stands in for the websocket to OctoPrint from the moment the server asks for it, so that nothing has to wait for it to connect.
+
+    def __init__(self, stats, relay):
+        self._mutex = threading.RLock()
+        self.stats = stats
+        self.relay = relay
+        self.ws = None
+        self.closed = False
+        self.pending = deque()
+        self.requested_ts = time.time()
+        self.first_frame_ts = None
+
+    def on_connected(self, ws):
+        with self._mutex:
+            if self.closed:     # tunnel_close came in while connecting
+                ws.close()
+                return
+
+            self.stats.record_connected()
+            self.ws = ws
+            while self.pending:     # Sends in the meantime wait for the mutex, so order is kept
+                ws.send(self.pending.popleft())
+
+    def on_first_frame(self):
+        if self.first_frame_ts is not None:
+            return
+        with self._mutex:
+            if self.first_frame_ts is None:
+                self.first_frame_ts = time.time()
+                self.stats.record_first_frame(self.first_frame_ts - self.requested_ts)
+
+    def send(self, data):
+        with self._mutex:
+            if self.ws is not None:
+                self.ws.send(data)
+                return
+
+            if self.closed:
+                return
+            if len(self.pending) >= WS_MAX_PENDING_FRAMES:
+                self.pending.popleft()
+                self.stats.record_pending_dropped()
+            self.pending.append(data)
+
+    def close(self):
+        self.relay.close()
+        with self._mutex:
+            self.closed = True
+            self.pending.clear()
+            ws = self.ws
+        if ws is not None:
+            ws.close()
@@ -0,0 +1,150 @@
+# coding=utf-8
+import logging
+import threading
+import time
+from collections import deque
+
+_logger = logging.getLogger('octoprint.plugins.obico')
+
+# Flow control for messages from a tunneled OctoPrint websocket to the server.
+#
+# A relay may have at most `credit_window` messages in the server message queue. A credit comes back when one of them
+# is taken off the queue. Until then, new messages wait in the relay, where OctoPrint's `current` pushes replace each
+# other, as only the latest printer state matters to the browser. If even that piles up, the OctoPrint websocket's
+# receive thread is held back, which in turn slows down OctoPrint through TCP.
+DEFAULT_CREDIT_WINDOW = 32
+MAX_PENDING = 500
+BLOCK_TIMEOUT = 10
+
+# OctoPrint's SockJS frames: 'a' + a JSON array of messages. Push messages are a dict with a single key.
+CURRENT_PUSH_PREFIXES = ('a[{"current"', '{"current"')
+
+
+def is_current_push(data):
+    return isinstance(data, str) and data.startswith(CURRENT_PUSH_PREFIXES)
+
+
+class TunnelRelay:
+
+    def __init__(self, send, credit_window=DEFAULT_CREDIT_WINDOW):
+        # send(data, on_dequeue): queues data to the server. Return: False if it was dropped
+        self._mutex = threading.RLock()
+        self._has_room = threading.Condition(self._mutex)
+        self.send = send
+        self.credit_window = credit_window
+        self.credits = credit_window
+        self.pending = deque()
+        self.pending_current = None
+        self.closed = False
+
+        self.started_ts = time.time()
+        self.msgs_in = 0
+        self.msgs_out = 0
+        self.bytes_out = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    def relay(self, data):
+        # Called on the receive thread of the OctoPrint websocket
+        received_ts = time.time()
+        with self._mutex:
+            if self.closed:
+                return
+            self.msgs_in += 1
+
+            if is_current_push(data) and self.pending_current is not None:
+                self.pending_current[0] = data
+                self.coalesced += 1
+                return
+
+            if self.pending or self.credits <= 0:
+                self._wait_for_room()
+                entry = [data, received_ts]
+                if is_current_push(data):
+                    self.pending_current = entry
+                self.pending.append(entry)
+                return
+
+            self.credits -= 1
+
+        self._send(data, received_ts)
+
+    def close(self):
+        with self._mutex:
+            self.closed = True
+            self.pending.clear()
+            self.pending_current = None
+            self._has_room.notify_all()
+
+    def as_dict(self):
+        with self._mutex:
+            elapsed = max(time.time() - self.started_ts, 1e-6)
+            return dict(
+                credits=self.credits,
+                credit_window=self.credit_window,
+                pending=len(self.pending),
+                msgs_in=self.msgs_in,
+                msgs_out=self.msgs_out,
+                bytes_out=self.bytes_out,
+                coalesced=self.coalesced,
+                dropped=self.dropped,
+                msgs_per_second=self.msgs_out / elapsed,
+                bytes_per_second=self.bytes_out / elapsed,
+                avg_lag_seconds=self.lag_total / self.msgs_out if self.msgs_out else None,
+                max_lag_seconds=self.lag_max,
+            )
+
+    def _wait_for_room(self):
+        deadline = time.time() + BLOCK_TIMEOUT
+        while len(self.pending) >= MAX_PENDING and not self.closed:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                entry = self.pending.popleft()
+                if entry is self.pending_current:
+                    self.pending_current = None
+                self.dropped += 1
+                _logger.warning('Tunnel relay is too far behind. Message dropped')
+                return
+            self._has_room.wait(remaining)
+
+    def _send(self, data, received_ts):
+        while True:
+            if self.send(data, self._dequeue_callback(data, received_ts)):
+                return
+
+            with self._mutex:
+                self.dropped += 1
+            entry = self._next_pending()
+            if entry is None:
+                return
+            (data, received_ts) = entry
+
+    def _dequeue_callback(self, data, received_ts):
+        def on_dequeue():
+            lag = time.time() - received_ts
+            with self._mutex:
+                self.msgs_out += 1
+                self.bytes_out += len(data) if data is not None else 0
+                self.lag_total += lag
+                self.lag_max = max(self.lag_max, lag)
+
+            entry = self._next_pending()
+            if entry is not None:
+                self._send(*entry)
+
+        return on_dequeue
+
+    def _next_pending(self):
+        # A credit came back. Return: the pending message to pass it on to, or None if the credit is kept
+        with self._mutex:
+            if self.closed or not self.pending:
+                self.credits = min(self.credits + 1, self.credit_window)
+                return None
+
+            entry = self.pending.popleft()
+            if entry is self.pending_current:
+                self.pending_current = None
+            self._has_room.notify()
+            return (entry[0], entry[1])
@@ -22,9 +22,20 @@ import requests
 
 from .lib.error_stats import error_stats
 from .lib import curlify
+from .lib.pooled_session import PooledSession
 
 PRINTER_SETTINGS_UPDATE_INTERVAL = 60*30.0  # Update printer settings at max 30 minutes interval, as they are relatively static.
 
+# (connect timeout, read timeout) in seconds, by the uri prefix of the server endpoint. First match wins.
+SERVER_REQUEST_TIMEOUTS = [
+    ('/api/v1/octo/pic/', (10, 60)),
+    ('/api/v1/octo/printer_events/', (10, 60)),
+    ('/api/v1/octo/g_code_files/', (10, 60)),
+    ('/ent/api/nozzle_cam/', (10, 60)),
+    ('/ent/api/printers/', (10, 60)),
+]
+DEFAULT_SERVER_REQUEST_TIMEOUT = (10, 30)
+
 _logger = logging.getLogger('octoprint.plugins.obico')
 
 
@@ -53,6 +64,48 @@ class ExpoBackoff:
             time.sleep(delay)
 
 
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self._mutex = threading.RLock()
+        self.rate = float(rate)    # tokens refilled per second
+        self.burst = float(burst)  # max tokens that can be accumulated
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def try_consume(self, n=1):
+        with self._mutex:
+            self._refill()
+            if self.tokens >= n:
+                self.tokens -= n
+                return True
+            return False
+
+    def consume(self, n=1):
+        # Block until n tokens are available, then take them
+        while True:
+            with self._mutex:
+                self._refill()
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def wait_time(self, n=1):
+        # Seconds until n tokens will be available. 0 if they are available now.
+        with self._mutex:
+            self._refill()
+            if self.tokens >= n:
+                return 0
+            return (n - self.tokens) / self.rate
+
+
 class OctoPrintSettingsUpdater:
 
     def __init__(self, plugin):
@@ -276,15 +329,28 @@ def wait_for_port_to_close(host, port):
             time.sleep(0.5)
 
 
-def server_request(method, uri, plugin, timeout=30, raise_exception=False, skip_debug_logging=False, **kwargs):
+# Shared by all calls to the server so that they reuse keep-alive connections instead of doing a TLS handshake every time.
+server_session = PooledSession()
+
+
+def server_request_timeout(uri):
+    for (prefix, timeout) in SERVER_REQUEST_TIMEOUTS:
+        if uri.startswith(prefix):
+            return timeout
+    return DEFAULT_SERVER_REQUEST_TIMEOUT
+
+
+def server_request(method, uri, plugin, timeout=None, raise_exception=False, skip_debug_logging=False, **kwargs):
     '''
     Return: A requests response object if it reaches the server. Otherwise None. Connections errors are printed to console but NOT raised
     '''
 
     endpoint = plugin.canonical_endpoint_prefix() + uri
+    if timeout is None:
+        timeout = server_request_timeout(uri)
     try:
         error_stats.attempt('server')
-        resp = requests.request(method, endpoint, timeout=timeout, **kwargs)
+        resp = server_session.request(method, endpoint, timeout=timeout, **kwargs)
 
         if not skip_debug_logging:
             _logger.debug(curlify.to_curl(resp.request))
@@ -1,18 +1,9 @@
 # coding=utf-8
 from __future__ import absolute_import
 import base64
-from datetime import datetime, timedelta
 import time
 import logging
 import threading
-
-try:
-    from StringIO import StringIO as Buffer
-    MJPEG_HDR = '\r\n' * 2
-except ImportError:
-    from io import BytesIO as Buffer
-    MJPEG_HDR = b'\r\n' * 2
-
 import re
 import os
 try:
@@ -31,10 +22,14 @@ from .lib.error_stats import error_stats
 from .utils import server_request
 
 
+MJPEG_HDR = b'\r\n' * 2
+
 POST_PIC_INTERVAL_SECONDS = 10.0
 if os.environ.get('DEBUG'):
     POST_PIC_INTERVAL_SECONDS = 3.0
 
+DEFAULT_JPEG_CACHE_MAX_AGE_SECONDS = 1.0
+
 _logger = logging.getLogger('octoprint.plugins.obico')
 
 def webcam_full_url(url):
@@ -48,9 +43,18 @@ def webcam_full_url(url):
     return full_url
 
 
+def capture_jpeg(webcam_settings, force_stream_url=False, use_nozzle_config=False, max_age=None):
+    # max_age: how old (in seconds) a jpeg captured for another caller can be to be reused. None for the configured default.
+    cache_key = (webcam_settings.get('snapshot'), webcam_settings.get('stream'), force_stream_url)
+    return jpeg_frame_cache.get(
+        cache_key,
+        lambda: _capture_jpeg(webcam_settings, force_stream_url=force_stream_url, use_nozzle_config=use_nozzle_config),
+        max_age=max_age)
+
+
 @backoff.on_exception(backoff.expo, Exception, max_tries=3)
 @backoff.on_predicate(backoff.expo, max_tries=3)
-def capture_jpeg(webcam_settings, force_stream_url=False, use_nozzle_config=False):
+def _capture_jpeg(webcam_settings, force_stream_url=False, use_nozzle_config=False):
     MAX_JPEG_SIZE = 5000000
 
     snapshot_url = webcam_full_url(webcam_settings.get("snapshot", ''))
@@ -74,48 +78,239 @@ def capture_jpeg(webcam_settings, force_stream_url=False, use_nozzle_config=Fals
         if not stream_url:
             raise Exception('Invalid Webcam snapshot URL "{}" or stream URL: "{}"'.format(snapshot_url, stream_url))
 
-        with closing(urlopen(stream_url)) as res:
-            chunker = MjpegStreamChunker()
-
-            data_bytes = 0
-            while True:
-                data = res.readline()
-                data_bytes += len(data)
-                if data == b'':
-                    raise Exception('End of stream before a valid jpeg is found')
-                if data_bytes > MAX_JPEG_SIZE:
-                    raise Exception('Reached the size cap before a valid jpeg is found.')
+        return mjpeg_stream_reader(stream_url).next_frame()
+
+
+class JpegFrameCache:
+    # Latest jpeg of each webcam, so that consumers asking within max_age of each other don't all go to the camera.
+
+    def __init__(self, max_age=DEFAULT_JPEG_CACHE_MAX_AGE_SECONDS):
+        self._mutex = threading.RLock()
+        self.max_age = max_age
+        self.frames = dict()        # cache_key -> (jpg, captured_ts)
+        self.capture_locks = dict() # cache_key -> lock held while capturing, so that concurrent callers wait for the same capture
+        self.hits = 0
+        self.misses = 0
+        self.capture_errors = 0
+        self.capture_seconds_total = 0.0
+        self.last_capture_seconds = None
+
+    def get(self, cache_key, capture, max_age=None):
+        if max_age is None:
+            max_age = self.max_age
+
+        asked_ts = time.time()
+        with self._mutex:
+            capture_lock = self.capture_locks.setdefault(cache_key, threading.RLock())
+
+        with capture_lock:
+            with self._mutex:
+                (jpg, captured_ts) = self.frames.get(cache_key, (None, 0))
+                # captured_ts >= asked_ts: it was captured for someone else while we were waiting
+                if jpg is not None and (captured_ts >= asked_ts or captured_ts >= time.time() - max_age):
+                    self.hits += 1
+                    return jpg
+                self.misses += 1
+
+            start = time.time()
+            try:
+                jpg = capture()
+            except Exception:
+                with self._mutex:
+                    self.capture_errors += 1
+                raise
+
+            with self._mutex:
+                now = time.time()
+                self.last_capture_seconds = now - start
+                self.capture_seconds_total += self.last_capture_seconds
+                if jpg:
+                    self.frames[cache_key] = (jpg, now)
+            return jpg
+
+    def as_dict(self):
+        with self._mutex:
+            captures = self.misses - self.capture_errors
+            return dict(
+                max_age=self.max_age,
+                hits=self.hits,
+                misses=self.misses,
+                capture_errors=self.capture_errors,
+                avg_capture_seconds=self.capture_seconds_total / captures if captures > 0 else None,
+                last_capture_seconds=self.last_capture_seconds,
+            )
+
+# Poor-man's singleton
+jpeg_frame_cache = JpegFrameCache()
+
+
+MJPEG_READ_SIZE = 64 * 1024
+MJPEG_FRAME_TIMEOUT_SECONDS = 5
+MJPEG_READER_IDLE_SECONDS = 3   # Close the connection when no one has asked for a frame for this long
+
+_mjpeg_stream_readers = {}
+_mjpeg_stream_readers_mutex = threading.RLock()
+
+
+def mjpeg_stream_reader(stream_url):
+    with _mjpeg_stream_readers_mutex:
+        reader = _mjpeg_stream_readers.get(stream_url)
+        if reader is None:
+            reader = MjpegStreamReader(stream_url)
+            _mjpeg_stream_readers[stream_url] = reader
+        return reader
+
+
+class MjpegStreamReader:
+    # Keeps one connection open to a mjpeg stream for as long as frames are being asked for, and hands the latest frame to every consumer.
+
+    def __init__(self, stream_url):
+        self.stream_url = stream_url
+        self._mutex = threading.RLock()
+        self._new_frame = threading.Condition(self._mutex)
+        self.frame = None
+        self.frame_seq = 0
+        self.running = False
+        self.generation = 0     # Of the reader thread. One that has exited on idle must not touch the state of the one that replaced it
+        self.waiting = 0
+        self.error = None
+        self.last_asked = 0
+
+    def next_frame(self, timeout=MJPEG_FRAME_TIMEOUT_SECONDS):
+        # Return: the first frame that arrives after this call, so that consecutive callers never get a stale frame.
+        deadline = time.time() + timeout
+        with self._new_frame:
+            self.last_asked = time.time()
+            if not self.running:
+                self.running = True
+                self.generation += 1
+                self.error = None
+                reader_thread = threading.Thread(target=self._read_loop, args=(self.generation,))
+                reader_thread.daemon = True
+                reader_thread.start()
+
+            seq = self.frame_seq
+            self.waiting += 1
+            try:
+                while self.frame_seq == seq:
+                    if not self.running:
+                        raise Exception(self.error or 'Mjpeg stream closed before a valid jpeg is found')
 
-                mjpg = chunker.findMjpegChunk(data)
-                if mjpg:
-                    res.close()
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Exception('Timed out waiting for a jpeg from the mjpeg stream')
+                    self._new_frame.wait(remaining)
+            finally:
+                self.waiting -= 1
 
-                    mjpeg_headers_index = mjpg.find(MJPEG_HDR)
-                    if mjpeg_headers_index > 0:
-                        return mjpg[mjpeg_headers_index+4:]
-                    else:
-                        raise Exception('Wrong mjpeg data format')
+            return self.frame
 
+    def _read_loop(self, generation):
+        error = None
+        try:
+            with closing(urlopen(self.stream_url, timeout=MJPEG_FRAME_TIMEOUT_SECONDS)) as res:
+                read = getattr(res, 'read1', res.read)   # read1 returns what is available instead of blocking until the buffer is full
+                parser = MjpegFrameParser()
+                while True:
+                    with self._mutex:
+                        # Decided under the same lock as next_frame starts a reader, so that a caller either keeps this one going, or starts a new one
+                        if not self.waiting and self.last_asked < time.time() - MJPEG_READER_IDLE_SECONDS:
+                            self.running = False
+                            return
+
+                    data = read(MJPEG_READ_SIZE)
+                    if not data:
+                        raise Exception('End of stream before a valid jpeg is found')
+
+                    for jpg in parser.feed(data):
+                        with self._new_frame:
+                            self.frame = jpg
+                            self.frame_seq += 1
+                            self._new_frame.notify_all()
+        except Exception as e:
+            error = str(e)
+        finally:
+            with self._new_frame:
+                if self.generation == generation and self.running:
+                    self.running = False
+                    self.error = error
+                    self._new_frame.notify_all()
+
+
+class MjpegFrameParser:
+    # Splits a multipart mjpeg stream into jpegs. Each part looks like:
+    #
+    #   --boundary\r\n
+    #   Content-Type: image/jpeg\r\n
+    #   Content-Length: 12345\r\n
+    #   \r\n
+    #   <jpeg>\r\n
+    #
+    # Content-Length is used when present. Otherwise the jpeg ends where the next boundary starts.
 
-class MjpegStreamChunker:
+    MAX_JPEG_SIZE = 5000000
 
     def __init__(self):
         self.boundary = None
-        self.current_chunk = Buffer()
+        self.buf = bytearray()
+        self.in_jpeg = False       # True once the headers of the current part are parsed
+        self.content_length = None
 
-    # Return: mjpeg chunk if found
-    #         None: in the middle of the chunk
-    def findMjpegChunk(self, line):
-        if not self.boundary:   # The first time endOfChunk should be called with 'boundary' text as input
-            self.boundary = line
-            self.current_chunk.write(line)
-            return None
+    def feed(self, data):
+        # Return: list of complete jpegs found so far
+        self.buf += data
+        jpgs = []
 
-        if len(line) == len(self.boundary) and line == self.boundary:  # start of next chunk
-            return self.current_chunk.getvalue()
+        while True:
+            if self.boundary is None:
+                line_end = self.buf.find(b'\r\n')
+                if line_end < 0:
+                    break
+                # Like the old line-by-line chunker, the first line of the stream is the boundary
+                self.boundary = bytes(self.buf[:line_end]).strip()
+                if not self.boundary:
+                    del self.buf[:line_end + 2]
+                    self.boundary = None
+                    continue
 
-        self.current_chunk.write(line)
-        return None
+            if not self.in_jpeg:
+                boundary_index = self.buf.find(self.boundary)
+                if boundary_index < 0:
+                    break
+                headers_end = self.buf.find(MJPEG_HDR, boundary_index)
+                if headers_end < 0:
+                    break
+
+                self.content_length = None
+                for header in bytes(self.buf[boundary_index + len(self.boundary):headers_end]).split(b'\r\n'):
+                    (name, _, value) = header.partition(b':')
+                    if name.strip().lower() == b'content-length':
+                        try:
+                            self.content_length = int(value.strip())
+                        except ValueError:
+                            pass
+
+                del self.buf[:headers_end + len(MJPEG_HDR)]
+                self.in_jpeg = True
+
+            if self.content_length is not None:
+                if len(self.buf) < self.content_length:
+                    break
+                jpgs.append(bytes(self.buf[:self.content_length]))
+                del self.buf[:self.content_length]
+            else:
+                next_boundary = self.buf.find(self.boundary)
+                if next_boundary < 0:
+                    break
+                jpgs.append(bytes(self.buf[:next_boundary]).rstrip(b'\r\n'))
+                del self.buf[:next_boundary]
+
+            self.in_jpeg = False
+
+        if len(self.buf) > self.MAX_JPEG_SIZE:
+            raise Exception('Reached the size cap before a valid jpeg is found.')
+
+        return jpgs
 
 
 class JpegPoster:
@@ -135,7 +330,7 @@ class JpegPoster:
             return
 
         data = {'viewing_boost': 'true'} if viewing_boost else {}
-        resp = server_request('POST', '/api/v1/octo/pic/', self.plugin, timeout=60, files=files, data=data, skip_debug_logging=True, headers=self.plugin.auth_headers())
+        resp = server_request('POST', '/api/v1/octo/pic/', self.plugin, files=files, data=data, skip_debug_logging=True, headers=self.plugin.auth_headers())
         _logger.debug('Jpeg posted to server - {0}'.format(resp))
 
     def pic_post_loop(self):
@@ -30,7 +30,7 @@ import psutil
 from octoprint.util import to_unicode
 import octoprint
 
-from .utils import pi_version, ExpoBackoff, get_image_info, parse_integer_or_none
+from .utils import pi_version, ExpoBackoff, TokenBucket, get_image_info, parse_integer_or_none
 from .lib import alert_queue
 from .webcam_capture import capture_jpeg, webcam_full_url
 from .janus_config_builder import build_janus_config
@@ -45,6 +45,10 @@ FFMPEG = os.path.join(FFMPEG_DIR, 'run.sh')
 JANUS_WS_PORT = 17730   # Janus needs to use 17730 up to 17750. Hard-coded for now. may need to make it dynamic if the problem of port conflict is too much
 JANUS_ADMIN_WS_PORT = JANUS_WS_PORT + 1
 
+MJPEG_CHUNK_SIZE = 1400
+MJPEG_DEFAULT_KBPS = 2800   # Roughly what the old fixed 4ms sleep between 1400-byte chunks allowed
+MJPEG_BURST_SECONDS = 0.05
+
 RECODE_RESOLUTIONS_43 = {
     'low': (320, 240),
     'medium': (640, 480),
@@ -82,6 +86,15 @@ def get_webcam_resolution(webcam_config):
     return (img_w, img_h)
 
 
+def send_paced(sock, addr, buf, pacer, chunk_size=MJPEG_CHUNK_SIZE):
+    # Slices of a memoryview share the underlying buffer, so the frame is not copied again to be chunked
+    view = memoryview(buf)
+    for i in range(0, len(view), chunk_size):
+        chunk = view[i:i + chunk_size]
+        pacer.consume(len(chunk))
+        sock.sendto(chunk, addr)
+
+
 def find_ffmpeg_h264_encoder():
     test_video = os.path.join(FFMPEG_DIR, 'test-video.mp4')
     FNULL = open(os.devnull, 'w')
@@ -441,9 +454,11 @@ class WebcamStreamer:
             mjpeg_dataport = webcam['runtime']['mjpeg_dataport']
 
             min_interval_btw_frames = 1.0 / float(webcam['target_fps'])
-            bandwidth_throttle = 0.004
+            kbps = parse_integer_or_none(webcam.get('mjpeg_bitrate_kbps')) or MJPEG_DEFAULT_KBPS
             if pi_version() == "0":    # If Pi Zero
-                bandwidth_throttle *= 2
+                kbps /= 2
+            bytes_per_second = kbps * 1000 / 8
+            pacer = TokenBucket(bytes_per_second, max(bytes_per_second * MJPEG_BURST_SECONDS, MJPEG_CHUNK_SIZE))
 
             mjpeg_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.mjpeg_sock_list.append(mjpeg_sock)
@@ -459,7 +474,7 @@ class WebcamStreamer:
 
                 jpg = None
                 try:
-                    jpg = capture_jpeg(webcam)
+                    jpg = capture_jpeg(webcam, max_age=min_interval_btw_frames / 2)
                 except Exception as e:
                     _logger.warning('Failed to capture jpeg - ' + str(e))
 
@@ -468,9 +483,7 @@ class WebcamStreamer:
 
                 encoded = base64.b64encode(jpg)
                 mjpeg_sock.sendto(bytes('\r\n{}:{}\r\n'.format(len(encoded), len(jpg)), 'utf-8'), ('127.0.0.1', mjpeg_dataport)) # simple header format for client to recognize
-                for chunk in [encoded[i:i+1400] for i in range(0, len(encoded), 1400)]:
-                    mjpeg_sock.sendto(chunk, ('127.0.0.1', mjpeg_dataport))
-                    time.sleep(bandwidth_throttle)
+                send_paced(mjpeg_sock, ('127.0.0.1', mjpeg_dataport), encoded, pacer)
 
         mjpeg_loop_thread = Thread(target=mjpeg_loop)
         mjpeg_loop_thread.daemon = True
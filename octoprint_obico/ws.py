@@ -12,6 +12,26 @@ _logger = logging.getLogger('octoprint.plugins.obico')
 class WebSocketConnectionException(Exception):
     pass
 
+
+_use_asyncio_transport = False
+
+def use_asyncio_transport(enabled):
+    global _use_asyncio_transport
+    _use_asyncio_transport = enabled
+
+
+def create_ws_client(*args, **kwargs):
+    # Return: an AsyncWebSocketClient if the asyncio transport is enabled and available. Otherwise a WebSocketClient
+    #   blocking_callbacks: the callbacks may block for long. Only matters to the asyncio transport, where callbacks share threads
+    if _use_asyncio_transport:
+        from .ws_asyncio import AsyncWebSocketClient, asyncio_transport_available
+        if asyncio_transport_available():
+            return AsyncWebSocketClient(*args, **kwargs)
+        _logger.warning('asyncio websocket transport is enabled but the "websockets" package is not installed. Falling back to websocket-client.')
+
+    kwargs.pop('blocking_callbacks', None)   # Each connection has its own thread anyway
+    return WebSocketClient(*args, **kwargs)
+
 class WebSocketClient:
 
     def __init__(self, url, token=None, on_ws_msg=None, on_ws_close=None, on_ws_open=None, subprotocols=None, waitsecs=120):
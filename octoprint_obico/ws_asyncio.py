@@ -0,0 +1,183 @@
+# coding=utf-8
+
+# Optional websocket transport that runs all connections on one asyncio event loop thread,
+# instead of a run_forever thread per connection plus a thread per on_open/on_error callback.
+# Requires the `websockets` package. Enabled with the `asyncio_ws_transport` setting.
+
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from websockets.exceptions import ConnectionClosed
+    try:
+        from websockets.asyncio.client import connect as ws_connect   # websockets >= 13
+        HEADERS_KWARG = 'additional_headers'
+    except ImportError:
+        from websockets import connect as ws_connect
+        HEADERS_KWARG = 'extra_headers'
+except ImportError:
+    ws_connect = None
+
+from .ws import WebSocketConnectionException
+
+_logger = logging.getLogger('octoprint.plugins.obico')
+
+SEND_TIMEOUT_SECONDS = 30
+DISPATCHER_WORKERS = 8
+BLOCKING_DISPATCHER_WORKERS = 16
+
+
+def asyncio_transport_available():
+    return ws_connect is not None
+
+
+class EventLoopThread:
+
+    def __init__(self):
+        self._mutex = threading.RLock()
+        self.loop = None
+
+    def get_loop(self):
+        with self._mutex:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                loop_thread = threading.Thread(target=self.loop.run_forever)
+                loop_thread.daemon = True
+                loop_thread.start()
+            return self.loop
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.get_loop())
+
+# Poor-man's singleton
+event_loop_thread = EventLoopThread()
+
+
+class CallbackDispatcher:
+    # Callbacks may block (and may call send), so they can't run on the event loop. They run on a pool shared by all
+    # connections instead, one at a time per connection so that the messages of a connection stay in order.
+
+    def __init__(self, max_workers=DISPATCHER_WORKERS):
+        self._mutex = threading.RLock()
+        self.max_workers = max_workers
+        self.executor = None
+        self.queues = dict()    # connection -> callbacks waiting to run. Only there while a worker is draining it
+
+    def dispatch(self, conn, callback, *args, **kwargs):
+        with self._mutex:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+            queue = self.queues.get(conn)
+            if queue is not None:
+                queue.append((callback, args, kwargs))
+                return
+            self.queues[conn] = deque([(callback, args, kwargs)])
+            self.executor.submit(self._drain, conn)
+
+    def _drain(self, conn):
+        while True:
+            with self._mutex:
+                queue = self.queues[conn]
+                if not queue:
+                    del self.queues[conn]
+                    return
+                (callback, args, kwargs) = queue.popleft()
+
+            try:
+                callback(*args, **kwargs)
+            except Exception:
+                _logger.exception('Websocket callback {} failed'.format(getattr(callback, '__name__', callback)))
+
+# Poor-man's singletons. Connections whose callbacks may block for long (e.g. tunnel back-pressure) get a pool of their own,
+# so that they can't hold up the callbacks of the others, such as messages from the server.
+callback_dispatcher = CallbackDispatcher()
+blocking_callback_dispatcher = CallbackDispatcher(max_workers=BLOCKING_DISPATCHER_WORKERS)
+
+
+class AsyncWebSocketClient:
+    # Same surface as WebSocketClient: the constructor returns once connected, then send/connected/close.
+    # Callbacks get the client (not the underlying connection), so they can call send and close from their thread.
+
+    def __init__(self, url, token=None, on_ws_msg=None, on_ws_close=None, on_ws_open=None, subprotocols=None, waitsecs=120, blocking_callbacks=False):
+        self._mutex = threading.RLock()
+        self.url = url
+        self.dispatcher = blocking_callback_dispatcher if blocking_callbacks else callback_dispatcher
+        self.ws = None
+        self._open = False
+        self.on_ws_msg = on_ws_msg
+        self.on_ws_close = on_ws_close
+        self.on_ws_open = on_ws_open
+
+        connect_kwargs = dict(max_size=None, ping_interval=None, compression=None)
+        if token:
+            connect_kwargs[HEADERS_KWARG] = {'authorization': 'bearer ' + token}
+        if subprotocols:
+            connect_kwargs['subprotocols'] = subprotocols
+
+        _logger.debug('Connecting to websocket: {}'.format(url))
+        future = event_loop_thread.run(asyncio.wait_for(self._connect(connect_kwargs), waitsecs))
+        try:
+            future.result()
+        except Exception as e:
+            _logger.debug('Failed to connect to websocket {}: {}'.format(url, e))
+            raise WebSocketConnectionException('Not connected to websocket server after {}s'.format(waitsecs))
+
+    async def _connect(self, connect_kwargs):
+        ws = await ws_connect(self.url, **connect_kwargs)
+        with self._mutex:
+            self.ws = ws
+            self._open = True
+
+        _logger.debug('WS Opened')
+        asyncio.ensure_future(self._receive_loop(ws))
+        if self.on_ws_open:
+            self._dispatch(self.on_ws_open, self)
+
+    async def _receive_loop(self, ws):
+        try:
+            async for msg in ws:
+                if self.on_ws_msg:
+                    self._dispatch(self.on_ws_msg, self, msg)
+        except ConnectionClosed:
+            pass
+        except Exception as e:
+            _logger.warning('Server WS ERROR: {}'.format(e))
+        finally:
+            with self._mutex:
+                self._open = False
+            _logger.warning('WS Closed - {} - {}'.format(ws.close_code, ws.close_reason))
+            if self.on_ws_close:
+                self._dispatch(self.on_ws_close, self, close_status_code=ws.close_code)
+
+    def _dispatch(self, callback, *args, **kwargs):
+        self.dispatcher.dispatch(self, callback, *args, **kwargs)
+
+    def send(self, data, as_binary=False):
+        with self._mutex:
+            if not self.connected():
+                return
+            ws = self.ws
+
+        # websockets picks the frame type from the data type
+        if as_binary and not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        elif not as_binary and isinstance(data, bytes):
+            data = data.decode('utf-8')
+
+        event_loop_thread.run(ws.send(data)).result(timeout=SEND_TIMEOUT_SECONDS)
+
+    def connected(self):
+        with self._mutex:
+            return self.ws is not None and self._open
+
+    def close(self):
+        # Safe to call from any thread: the close is scheduled on the event loop
+        with self._mutex:
+            ws = self.ws
+            self._open = False
+        if ws is not None:
+            event_loop_thread.run(ws.close())